@@ -38,6 +38,10 @@ CONFIG="lims-cromwell-config"
 # Name of key where the Cromwell SA credentials are stored in the Runtime Config
 CONFIG_KEY="cromwell-sa-key"
 
+# Bucket for state shared between function instances: event claims, leases,
+# import journals, the submission dedupe index and rewrite tokens
+STATE_BUCKET="$PROJECT-lims-state"
+
 # TODO change firebase key to a new one
 # Name and location of the KMS key used to encrypt/decrypt the Cromwell SA creds
 KMS_KEY="firebase"
@@ -153,6 +157,21 @@ ENCRYPTED_KEY=$(gcloud beta runtime-config configs variables \
   get-value "${CONFIG_KEY}" \
   --config-name "${CONFIG}")
 
+# Create the state bucket; entries are only needed for a few days
+if ! gsutil ls -b gs://$STATE_BUCKET > /dev/null 2>&1; then
+  gsutil mb -l $REGION -b on gs://$STATE_BUCKET
+else
+  echo "State bucket already exists"
+fi
+LIFECYCLE=$(mktemp)
+echo '{"rule": [{"action": {"type": "Delete"}, "condition": {"age": 30}}]}' > $LIFECYCLE
+gsutil lifecycle set $LIFECYCLE gs://$STATE_BUCKET
+rm $LIFECYCLE
+
+# Both functions create, replace and delete state entries
+gsutil iam ch "serviceAccount:$FUNCTION_SA:objectAdmin" gs://$STATE_BUCKET
+gsutil iam ch "serviceAccount:$CROMWELL_SA:objectAdmin" gs://$STATE_BUCKET
+
 # Deploy Cromwell launcher function, passing encrypted key
 # as env variable. Note that it's unauthenticated, but we
 # set up a load balancer and firewall around it elsewhere
@@ -166,7 +185,7 @@ gcloud functions deploy cromwell-launcher \
     --trigger-http \
     --allow-unauthenticated \
     --ingress-settings internal-and-gclb \
-    --set-env-vars KEY=$ENCRYPTED_KEY,KMS_KEY=$KMS_KEY,KMS_LOCATION=$KMS_LOCATION,PROJECT=$PROJECT,ENDPOINT=$CROMWELL_ENDPOINT
+    --set-env-vars KEY=$ENCRYPTED_KEY,KMS_KEY=$KMS_KEY,KMS_LOCATION=$KMS_LOCATION,PROJECT=$PROJECT,ENDPOINT=$CROMWELL_ENDPOINT,STATE_BUCKET=$STATE_BUCKET
 
 echo "Deployed Cromwell launcher function"
 
@@ -231,5 +250,7 @@ gcloud functions deploy on-workflow-done \
     --ingress-settings internal-only \
     --vpc-connector workflow-vpc-connector \
     --egress-settings all \
-    --set-env-vars PROJECT=$PROJECT,LIMS_USERNAME=$LIMS_USERNAME,LIMS_PASSWORD=$LIMS_PASSWORD
-# TODO add retry flag? https://cloud.google.com/functions/docs/bestpractices/retries
\ No newline at end of file
+    --retry \
+    --set-env-vars PROJECT=$PROJECT,LIMS_USERNAME=$LIMS_USERNAME,LIMS_PASSWORD=$LIMS_PASSWORD,STATE_BUCKET=$STATE_BUCKET
+# Failed deliveries are retried, including ones that find an event still claimed
+# by another invocation. See https://cloud.google.com/functions/docs/bestpractices/retries
@@ -0,0 +1,361 @@
+import copy
+import json
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import requests
+
+FIRECLOUD_API = "https://api.firecloud.org/api"
+NAMESPACE = "Shoresh_operations_workflows"
+WORKSPACE = "lims_terra"
+
+# Per-job method configurations are named "<method>__job__<timestamp>__<id>"
+# and are deleted once they are older than JOB_CONFIG_TTL_HOURS
+JOB_CONFIG_MARKER = "__job__"
+JOB_CONFIG_TIME_FORMAT = "%Y%m%d%H%M%S"
+JOB_CONFIG_TTL_HOURS = float(os.environ.get("JOB_CONFIG_TTL_HOURS", "24"))
+
+# Method configurations by method name, as (etag, configuration), and live
+# per-job configurations by (method, method snapshot, configuration version,
+# inputs hash), as (created_at, name)
+config_cache = {}
+job_config_cache = {}
+cache_lock = threading.Lock()
+
+# Batch submissions keep their rows and sets in entity types with this
+# prefix, named after the batch id "<timestamp>__<id>"; they are swept
+# along with the per-job configurations, BATCH_DELETE_SIZE per request
+BATCH_ENTITY_PREFIX = "lims_"
+BATCH_DELETE_SIZE = int(os.environ.get("BATCH_DELETE_SIZE", "500"))
+
+# Stale per-job configurations are swept at most this often per instance
+CLEANUP_INTERVAL = timedelta(hours=1)
+last_cleanup = None
+
+
+def workspace_endpoint(path=""):
+    return f"{FIRECLOUD_API}/workspaces/{NAMESPACE}/{WORKSPACE}{path}"
+
+
+def method_config_endpoint(name):
+    return workspace_endpoint(f"/method_configs/{NAMESPACE}/{name}")
+
+
+def get_method_config(name, header, etag=None):
+    # With an ETag, an unchanged configuration comes back as a bodiless 304
+    if etag:
+        header = {**header, "If-None-Match": etag}
+    return requests.get(method_config_endpoint(name), headers=header)
+
+
+def get_cached_method_config(method, header):
+    """
+    Returns a private copy of the method's configuration.
+
+    The cached copy is revalidated on every call, with a conditional GET
+    when Firecloud sent an ETag for it, so that a configuration moved to a
+    new WDL snapshot or version is picked up by the very next launch.
+    """
+    with cache_lock:
+        cached = config_cache.get(method)
+    response = get_method_config(method, header, cached[0] if cached else None)
+    if cached and response.status_code == 304:
+        configuration = cached[1]
+        print(f"Method configuration cache hit for {method} "
+              f"(version {configuration.get('methodConfigVersion')})")
+    else:
+        response.raise_for_status()
+        configuration = response.json()
+        version = configuration.get("methodConfigVersion")
+        if cached and cached[1].get("methodConfigVersion") == version:
+            print(f"Method configuration {method} unchanged (version {version})")
+        else:
+            print(f"Method configuration cache miss for {method} (version {version})")
+        with cache_lock:
+            config_cache[method] = (response.headers.get("ETag"), configuration)
+    return copy.deepcopy(configuration)
+
+
+def get_inputs_hash(inputs):
+    # The canonical JSON hash that names trackview configs; imported here
+    # so that loading this module does not load the storage client
+    from trackview import get_hash
+
+    return get_hash(inputs)
+
+
+def get_job_config(method, template, inputs, header):
+    """
+    Returns the name of a per-job configuration holding these inputs,
+    reusing one this instance already created when the inputs are
+    identical, the template still points at the same method snapshot and
+    configuration version, and the configuration is well within its
+    cleanup TTL.
+    """
+    key = (
+        method,
+        get_inputs_hash(template.get("methodRepoMethod")),
+        template.get("methodConfigVersion"),
+        get_inputs_hash(inputs),
+    )
+    now = datetime.utcnow()
+    with cache_lock:
+        cached = job_config_cache.get(key)
+    if cached and now - cached[0] < timedelta(hours=JOB_CONFIG_TTL_HOURS / 2):
+        print(f"Inputs unchanged, reusing method configuration {cached[1]}")
+        return cached[1]
+    name = create_job_config(method, template, inputs, header)
+    with cache_lock:
+        job_config_cache[key] = (now, name)
+    return name
+
+
+def job_config_name(method):
+    timestamp = datetime.utcnow().strftime(JOB_CONFIG_TIME_FORMAT)
+    return f"{method}{JOB_CONFIG_MARKER}{timestamp}__{uuid.uuid4().hex[:8]}"
+
+
+def create_job_config(method, template, inputs, header, root_entity_type=None):
+    """
+    Creates a uniquely named copy of the method's configuration holding a
+    single job's inputs, so concurrent launches never overwrite each other.
+    """
+    name = job_config_name(method)
+    configuration = {
+        **template,
+        "namespace": NAMESPACE,
+        "name": name,
+        "inputs": inputs,
+        "outputs": {},
+    }
+    if root_entity_type:
+        configuration["rootEntityType"] = root_entity_type
+    response = requests.post(
+        workspace_endpoint("/methodconfigs"), headers=header, json=configuration
+    )
+    print(f"Created method configuration {name}: {response.status_code}")
+    response.raise_for_status()
+    return name
+
+
+def delete_method_config(name, header):
+    response = requests.delete(method_config_endpoint(name), headers=header)
+    print(f"Deleted method configuration {name}: {response.status_code}")
+
+
+def parse_job_timestamp(timestamp):
+    try:
+        return datetime.strptime(timestamp, JOB_CONFIG_TIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def cleanup_job_configs(header, max_age=timedelta(hours=JOB_CONFIG_TTL_HOURS)):
+    global last_cleanup
+    now = datetime.utcnow()
+    if last_cleanup and now - last_cleanup < CLEANUP_INTERVAL:
+        return
+    last_cleanup = now
+    response = requests.get(workspace_endpoint("/methodconfigs"), headers=header)
+    response.raise_for_status()
+    cutoff = now - max_age
+    for config in response.json():
+        name = config.get("name", "")
+        if config.get("namespace") != NAMESPACE or JOB_CONFIG_MARKER not in name:
+            continue
+        timestamp = name.split(JOB_CONFIG_MARKER, 1)[1].split("__", 1)[0]
+        created = parse_job_timestamp(timestamp)
+        if created and created < cutoff:
+            delete_method_config(name, header)
+    cleanup_batch_entities(header, cutoff)
+
+
+def cleanup_batch_entities(header, cutoff):
+    """
+    Deletes the row and set entities of batch submissions created before
+    cutoff, so the workspace's lims_* tables do not grow without bound.
+    """
+    response = requests.get(workspace_endpoint("/entities"), headers=header)
+    response.raise_for_status()
+    entity_types = [t for t in response.json() if t.startswith(BATCH_ENTITY_PREFIX)]
+    # Sets are deleted before the rows they reference
+    entity_types.sort(key=lambda t: not t.endswith("_set"))
+    stale = []
+    for entity_type in entity_types:
+        response = requests.get(workspace_endpoint(f"/entities/{entity_type}"), headers=header)
+        response.raise_for_status()
+        for entity in response.json():
+            created = parse_job_timestamp(entity["name"].split("__", 1)[0])
+            if created and created < cutoff:
+                stale.append({"entityType": entity_type, "entityName": entity["name"]})
+    for i in range(0, len(stale), BATCH_DELETE_SIZE):
+        chunk = stale[i:i + BATCH_DELETE_SIZE]
+        response = requests.post(
+            workspace_endpoint("/entities/delete"), headers=header, json=chunk
+        )
+        print(f"Deleted {len(chunk)} batch entities: {response.status_code}")
+        response.raise_for_status()
+
+
+def submit(config_name, comment, header, entity_type=None, entity_name=None,
+           expression=None):
+    submission_manifest = {
+        "methodConfigurationNamespace": NAMESPACE,
+        "methodConfigurationName": config_name,
+        "userComment": comment[:1000] if len(comment) > 1000 else comment,
+        "entityType": entity_type,
+        "entityName": entity_name,
+        "expression": expression,
+        "useCallCache": True,
+        "deleteIntermediateOutputFiles": False,
+        "useReferenceDisks": False,
+        "memoryRetryMultiplier": 1,
+        "workflowFailureMode": "NoNewCalls",
+        "ignoreEmptyOutputs": True
+    }
+    return requests.post(
+        workspace_endpoint("/submissions"), json=submission_manifest, headers=header
+    )
+
+
+def get_submission(submission_id, header):
+    response = requests.get(
+        workspace_endpoint(f"/submissions/{submission_id}"), headers=header
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+# Submission states for which a resubmission of the same inputs is redundant
+ACTIVE_SUBMISSION_STATUSES = {"Accepted", "Evaluating", "Submitting", "Submitted"}
+
+
+def get_submission_status(submission):
+    status = submission.get("status")
+    if status in ACTIVE_SUBMISSION_STATUSES:
+        return "Running"
+    if status == "Done":
+        workflows = submission.get("workflows", [])
+        if workflows and all(w.get("status") == "Succeeded" for w in workflows):
+            return "Succeeded"
+        return "Failed"
+    return status
+
+
+def find_duplicate_submission(index, method, inputs, header):
+    """
+    Looks up a submission of identical inputs in the dedupe index and
+    returns its entry if it is still running or has succeeded.
+    """
+    key = f"submissions/{method}/{get_inputs_hash(inputs)}"
+    entry = index.get(key)
+    if entry is None:
+        return None
+    try:
+        submission = get_submission(entry["submissionId"], header)
+        entry["status"] = get_submission_status(submission)
+    except requests.RequestException as err:
+        # A deleted or inaccessible submission must not block new runs
+        print(f"Could not look up submission {entry['submissionId']}: {err}")
+        entry["status"] = "Unavailable"
+    index.put(key, entry)
+    if entry["status"] in ("Running", "Succeeded"):
+        return entry
+    return None
+
+
+def record_submission(index, method, inputs, submission_id, subj_name):
+    index.put(f"submissions/{method}/{get_inputs_hash(inputs)}", {
+        "submissionId": submission_id,
+        "status": "Running",
+        "subj_name": subj_name,
+        "submitted": datetime.utcnow().isoformat(),
+    })
+
+
+def upsert_entities(entities, header):
+    response = requests.post(
+        workspace_endpoint("/entities/batchUpsert"), headers=header, json=entities
+    )
+    print(f"Upserted {len(entities)} entities: {response.status_code}")
+    response.raise_for_status()
+
+
+def input_attribute_name(input_name):
+    # Entity attribute names cannot contain the dots used in WDL input names
+    return input_name.replace(".", "__")
+
+
+def input_attribute_value(expression):
+    # Formatters produce WDL literal expressions; rows hold the values
+    try:
+        return json.loads(expression)
+    except ValueError:
+        return expression
+
+
+def submit_entity_set(method, template, rows, subj_names, header):
+    """
+    Launches a group of jobs for one method as a single submission.
+
+    Each job's formatted inputs become the attributes of one row entity,
+    the rows are collected in an entity set, and a per-batch configuration
+    rooted on the row type reads its inputs from those attributes.
+    Returns the submission response and the row entity names, in order.
+    """
+    row_type = "lims_" + method.replace("-", "_")
+    set_type = f"{row_type}_set"
+    batch_id = job_config_name(method).split(JOB_CONFIG_MARKER, 1)[1]
+
+    entities = []
+    row_names = []
+    input_names = set()
+    for i, (inputs, subj_name) in enumerate(zip(rows, subj_names)):
+        row_name = f"{batch_id}_{i:04d}"
+        row_names.append(row_name)
+        input_names.update(inputs)
+        operations = [
+            {
+                "op": "AddUpdateAttribute",
+                "attributeName": input_attribute_name(name),
+                "addUpdateAttribute": input_attribute_value(expression),
+            }
+            for name, expression in inputs.items()
+        ]
+        operations.append({
+            "op": "AddUpdateAttribute",
+            "attributeName": "subj_name",
+            "addUpdateAttribute": subj_name,
+        })
+        entities.append(
+            {"name": row_name, "entityType": row_type, "operations": operations}
+        )
+
+    members = f"{row_type}s"
+    set_operations = [{"op": "CreateAttributeEntityReferenceList", "attributeListName": members}]
+    set_operations.extend(
+        {
+            "op": "AddListMember",
+            "attributeListName": members,
+            "newMember": {"entityType": row_type, "entityName": row_name},
+        }
+        for row_name in row_names
+    )
+    entities.append({"name": batch_id, "entityType": set_type, "operations": set_operations})
+    upsert_entities(entities, header)
+
+    inputs = {name: f"this.{input_attribute_name(name)}" for name in sorted(input_names)}
+    config_name = create_job_config(
+        method, template, inputs, header, root_entity_type=row_type
+    )
+    response = submit(
+        config_name,
+        ",".join(subj_names),
+        header,
+        entity_type=set_type,
+        entity_name=batch_id,
+        expression=f"this.{members}",
+    )
+    return response, row_names
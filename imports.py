@@ -2,83 +2,83 @@ import json
 import os
 from collections import defaultdict
 
-import requests
 from requests.exceptions import HTTPError
-from google.cloud import storage as gcs_storage
 
-def chunk_list(lst, chunk_size):
-    return [lst[i:i + chunk_size] for i in range(0, len(lst), chunk_size)]
+from lims_client import LimsWriteBuffer, get_client, quote_value
+from stages import Stage, run_stages
+from storage_helpers import copy_gcs_files, lease
 
 def import_subjects(project, username, password, subject_type, data):
-    project = "dev-" if "dev" in project else ""
-    params = {
-        "method": "import_subjects",
-        "subject_type": subject_type,
-        "username": username,
-        "password": password,
-        "json": json.dumps(data),
-    }
+    if not data:
+        print(f"No {subject_type} subjects to import")
+        return {"names": "", "ids": ""}
+    client = get_client(project, username, password)
     try:
-        response = requests.get(
-            "https://lims.{0}epi.broadinstitute.org/api".format(project),
-            params=params,
-            headers={"Content-Type": "application/json"},
-        )
-        print(f"Response: {response}")
+        return client.import_subjects(subject_type, data)
     except HTTPError as http_err:
         print(f"HTTP error occurred: {http_err}")
     except Exception as err:
         print(f"Error: {err}")
-    else:
-        return response.json()
-
-
-def query_subjects(project, username, password, subject_type, query):
-    project = "dev-" if "dev" in project else ""
-    params = {
-        "method": "subjects",
-        "subject_type": subject_type,
-        "query": query,
-        "limit": "5000",
-        "username": username,
-        "password": password,
-    }
+
+
+def query_subjects(project, username, password, subject_type, query, udf_names, use_cache=True):
+    client = get_client(project, username, password)
     try:
-        response = requests.get(
-            "https://lims.{0}epi.broadinstitute.org/api".format(project),
-            params=params,
-            headers={"Content-Type": "application/json"},
-        )
-        print(f"Response: {response}")
+        yield from client.query_subjects(subject_type, query, udf_names, use_cache)
     except HTTPError as http_err:
         print(f"HTTP error occurred: {http_err}")
+        raise
     except Exception as err:
         print(f"Error: {err}")
-    else:
-        return response.json()
+        raise
+
+
+def query_subjects_in(project, username, password, subject_type, field, values, udf_names,
+                      use_cache=True):
+    client = get_client(project, username, password)
+    try:
+        yield from client.query_subjects_in(subject_type, field, values, udf_names, use_cache)
+    except HTTPError as http_err:
+        print(f"HTTP error occurred: {http_err}")
+        raise
+    except Exception as err:
+        print(f"Error: {err}")
+        raise
+
+
+def _freeze(value):
+    # Make UDF values hashable so they can be used as index keys
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _subject_key(udf_values):
+    return tuple(sorted((name, _freeze(value)) for name, value in udf_values.items()))
 
 
-def parse_query(response, udf_names):
-    result = {}
-    for subject in response["Subjects"]:
-        udf_values = {}
-        for udf in subject["udfs"]:
-            if udf["name"] in udf_names:
-                if "subject_count" in udf:
-                    udf_values[udf["name"]] = udf["subject_count"]
-                elif isinstance(udf["value"], dict):
-                    udf_values[udf["name"]] = udf["value"]["name"]
-                else:
-                    udf_values[udf["name"]] = udf["value"]
-        result[str(subject["id"])] = udf_values
-    return result
+def parse_query(records, udf_names):
+    # Index subject UIDs by their search UDF values so that
+    # check_subjects is a single lookup instead of a full scan
+    result = defaultdict(list)
+    uid_names = {}
+    uid_udfs = {}
+    for record in records:
+        # The same subject can come back on more than one page
+        if record.id in uid_names:
+            continue
+        search_udfs = {name: value for name, value in record.udfs.items() if name in udf_names}
+        result[_subject_key(search_udfs)].append(record.id)
+        uid_names[record.id] = record.name
+        uid_udfs[record.id] = record.udfs
+    print(f"Found {len(uid_names)} existing subjects")
+    return result, uid_names, uid_udfs
 
 
 def check_subjects(parsed_query, search_udfs):
-    matching_subjects = []
-    for uid, udfs in parsed_query.items():
-        if udfs == search_udfs:
-            matching_subjects.append(uid)
+    matching_subjects = parsed_query.get(_subject_key(search_udfs), [])
     if len(matching_subjects) == 0:
         return {}
     elif len(matching_subjects) > 1:
@@ -88,18 +88,80 @@ def check_subjects(parsed_query, search_udfs):
         return {"UID": matching_subjects[0]}
 
 
-def _copy_gcs_file(src_uri, dst_bucket_name, dst_path):
-    client = gcs_storage.Client()
-    src_bucket_name, src_blob_name = src_uri[5:].split("/", 1)
-    src_bucket = client.bucket(src_bucket_name)
-    src_blob = src_bucket.blob(src_blob_name)
-    src_bucket.copy_blob(src_blob, client.bucket(dst_bucket_name), dst_path)
-    return f"gs://{dst_bucket_name}/{dst_path}"
+def match_subjects(query, udf_names, subjects, searches, extra_fields=()):
+    """
+    Sets the UID of every subject that already exists in LIMS.
+
+    query is called with the UDF names to fetch: the search UDFs plus every
+    field the subjects (and any later updates, extra_fields) will write, so
+    that the current values can be diffed by changed_subjects. Returns the
+    names and the current field values of the existing subjects by UID.
+
+    The diff is only as fresh as the query, so query must bypass the
+    query cache (use_cache=False); a value changed elsewhere within the
+    cache TTL would otherwise make a needed write look unchanged.
+    """
+    fields = set(udf_names).union(extra_fields, *subjects) - {"UID"}
+    parsed_response, uid_names, uid_udfs = parse_query(query(sorted(fields)), udf_names)
+    for subject, search_udfs in zip(subjects, searches):
+        subject.update(check_subjects(parsed_response, search_udfs))
+    # A UDF without a value is left out of the response
+    existing = {
+        uid: {field: udfs.get(field) for field in fields}
+        for uid, udfs in uid_udfs.items()
+    }
+    return uid_names, existing
+
+
+def _normalize(value):
+    # LIMS returns numbers as strings and subject references as names
+    if isinstance(value, dict):
+        return _normalize(value.get("name"))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    if value is None:
+        return ""
+    return str(value)
+
+
+def changed_subjects(subject_type, subjects, existing):
+    """
+    Drops existing subjects whose fields already hold the desired values
+    and trims the others down to their UID and changed fields. New
+    subjects are kept whole. Every written field is fetched by
+    match_subjects, so a field missing from the response counts as empty.
+    """
+    changed = []
+    for subject in subjects:
+        current = existing.get(subject.get("UID"))
+        if current is None:
+            changed.append(subject)
+            continue
+        fields = {
+            name: value for name, value in subject.items()
+            if name != "UID" and _normalize(value) != _normalize(current.get(name))
+        }
+        if fields:
+            changed.append({"UID": subject["UID"], **fields})
+    print(f"{len(subjects) - len(changed)} of {len(subjects)} {subject_type} subjects unchanged")
+    return changed
+
+
+def _gcs_uri(bucket_name, path):
+    return f"gs://{bucket_name}/{path}"
+
 
+def _public_url(gcs_uri):
+    return "https://storage.googleapis.com/" + gcs_uri[5:]
 
-def _copy_public_gcs_file(src_uri, dst_bucket_name, dst_path):
-    _copy_gcs_file(src_uri, dst_bucket_name, dst_path)
-    return f"https://storage.googleapis.com/{dst_bucket_name}/{dst_path}"
+
+def _copy_gcs_files(copies):
+    results = copy_gcs_files(copies)
+    failed = [r for r in results if r.error is not None]
+    if failed:
+        summary = ", ".join(f"{r.src} -> {r.dst} ({r.error})" for r in failed)
+        raise RuntimeError(f"{len(failed)} of {len(results)} copies failed: {summary}")
+    return [r.dst for r in results]
 
 
 def _get_projects_set(projects):
@@ -121,17 +183,29 @@ def _collect_uids(lims_subjects, import_response, key_field):
     return uid_map
 
 
+def run_import(project, username, password, stages_fn, journal=None):
+    """
+    Runs the import stages that stages_fn builds around a LIMS write
+    buffer, journaling each completed stage. Writes whose responses are
+    not needed are coalesced in the buffer and sent last, even when a
+    stage fails. Returns the result of every stage by name.
+    """
+    writes = LimsWriteBuffer(get_client(project, username, password), journal)
+    try:
+        return run_stages(stages_fn(writes), journal)
+    finally:
+        writes.flush()
+
+
 def import_lanes(project, username, password, context, outputs):
     lims_lanes = []
     lanes = outputs["laneOutputs"]
     lane_type = "Paired" if lanes[0]["libraryOutputs"][0]["read2"] else "Single"
     # Query for existing lanes
     flowcell = outputs["flowcellId"]
-    lims_query = "\"Flow Cell\" = '{}'".format(flowcell)
+    lims_query = "\"Flow Cell\" = {}".format(quote_value(flowcell))
     udf_names = ["Flow Cell", "Lane-of-FC"]
-    query_response = query_subjects(project, username, password, "LIMS_Lane", lims_query)
-    print(query_response)
-    parsed_response = parse_query(query_response, udf_names)
+    searches = []
     for lane_output in outputs["laneOutputs"]:
         lims_lanes.append(
             {
@@ -144,16 +218,23 @@ def import_lanes(project, username, password, context, outputs):
                 "Lane Type": lane_type
             }
         )
-        search_udfs = {
+        searches.append({
             "Flow Cell": outputs["flowcellId"],
             "Lane-of-FC": str(lane_output["lane"])
-        }
-        uid_dict = check_subjects(parsed_response, search_udfs)
-        lims_lanes[-1].update(uid_dict)
-    uid_names = {str(d['id']): d['name'] for d in query_response['Subjects']}
+        })
+    # Concurrent imports of the same flowcell must not both create its lanes
+    with lease(f"flowcell/{flowcell}"):
+        uid_names, existing = match_subjects(
+            lambda fields: query_subjects(
+                project, username, password, "LIMS_Lane", lims_query, fields, use_cache=False
+            ),
+            udf_names, lims_lanes, searches
+        )
+        import_response = import_subjects(
+            project, username, password, "LIMS_Lane", changed_subjects("LIMS_Lane", lims_lanes, existing)
+        )
     search_uids = [d.get('UID', '{}') for d in lims_lanes]
     search_names = ','.join([uid_names.get(uid, '{}') for uid in search_uids])
-    import_response = import_subjects(project, username, password, "LIMS_Lane", lims_lanes)
     print(import_response)
     imported_names = (import_response['names'].split(','))
     # imported_names = (
@@ -172,13 +253,9 @@ def import_copseqreqs(project, username, password, context, outputs):
     seq_tech_project = "HiSeq_Mint_ChIP" if seq_tech == "Mint-ChIP" else "HiSeq_ChIP"
     
     # Query for existing CoPSeqReqs
-    quoted_copas = ",".join(f"'{copa}'" for copa in copas)
-    lims_query = "\"CoPA\"->name = ({})".format(quoted_copas)
     udf_names = ["CoPA"]
-    query_response = query_subjects(project, username, password, "CoPSeqReq", lims_query)
-    print(query_response)
-    parsed_response = parse_query(query_response, udf_names)
     copseqreqs = []
+    searches = []
     for copa in copas:
         copseqreqs.append({
             "CoPA": copa,
@@ -186,40 +263,42 @@ def import_copseqreqs(project, username, password, context, outputs):
             "Sequencing Center Project": seq_tech_project,
             "Projects": context["projects"].get(copa)
         })
-        search_udfs = {
+        searches.append({
             "CoPA": copa,
-        }
-        uid_dict = check_subjects(parsed_response, search_udfs)
-        copseqreqs[-1].update(uid_dict)
-    imported_names = []
-    batches = chunk_list(copseqreqs, 10)
-    for group in batches:
-        import_response = import_subjects(project, username, password, "CoPSeqReq", group)
-        print(import_response)
-        if import_response['names']:  # Only extend if names is not empty
-            imported_names.extend(import_response['names'].split(','))
-    uid_names = {str(d['id']): d['name'] for d in query_response['Subjects']}
+        })
+    # Concurrent imports of the same pool aliquot must not both create its CoPSeqReqs
+    with lease(f"pool-aliquot/{context['poolAliquotUID']}"):
+        uid_names, existing = match_subjects(
+            lambda fields: query_subjects_in(
+                project, username, password, "CoPSeqReq", '"CoPA"->name', copas, fields,
+                use_cache=False
+            ),
+            udf_names, copseqreqs, searches
+        )
+        import_response = import_subjects(
+            project, username, password, "CoPSeqReq",
+            changed_subjects("CoPSeqReq", copseqreqs, existing)
+        )
+    print(import_response)
+    imported_names = import_response['names'].split(',') if import_response['names'] else []
     search_uids = [d.get('UID', '{}') for d in copseqreqs]
     search_names = ','.join([uid_names.get(uid, '{}') for uid in search_uids])
     all_names = search_names.format(*imported_names).split(',')
     return all_names
 
-def import_lane_subsets(project, username, password, context, outputs, lims_lanes, copseqreqs):
+def import_lane_subsets(project, username, password, context, outputs, lims_lanes, copseqreqs, writes):
     # Query for existing lanes
     pa_uid = context["poolAliquotUID"]
     read_length = outputs["meanReadLength"]
     projects = context["projects"]
     lims_query = "\"Component of Pooled SeqReq\"->\"CoPA\"->\"Pool Aliquot\"->id = {}".format(pa_uid)
     udf_names = ["Component of Pooled SeqReq", "LIMS_Lane"]
-    query_response = query_subjects(project, username, password, "Lane Subset", lims_query)
-    print(query_response)
-    parsed_response = parse_query(query_response, udf_names)
+    lane_subsets = []
+    searches = []
     for lane_output, lims_lane in zip(outputs["laneOutputs"], lims_lanes):
-        lane_subsets = []
-        buffer = []
         for library_output, copseqreq in zip(lane_output["libraryOutputs"], copseqreqs):
             coPA = library_output["name"]
-            buffer.append({
+            lane_subsets.append({
                 "LIMS_Lane": lims_lane,
                 "Component of Pooled SeqReq": copseqreq,
                 "Reads 1 Filename URI": library_output["read1"],
@@ -231,22 +310,20 @@ def import_lane_subsets(project, username, password, context, outputs, lims_lane
                 "PF Fragments (BC)": library_output["pfFragments"],
                 "Projects": projects[coPA]
             })
-            search_udfs = {
+            searches.append({
                 "Component of Pooled SeqReq": copseqreq,
                 "LIMS_Lane": lims_lane
-            }
-            uid_dict = check_subjects(parsed_response, search_udfs)
-            buffer[-1].update(uid_dict)
-            if len(buffer) == 10:
-                lane_subsets.append(buffer)
-                buffer = []  # Start a new buffer array
-        if buffer:
-            lane_subsets.append(buffer)
-        for group in lane_subsets:
-            print(import_subjects(project, username, password, "Lane Subset", group))
-    return lane_subsets#import_subjects(project, username, password, "Lane Subset", lane_subsets)
-
-def update_pa(project, username, password, context, outputs):
+            })
+    _, existing = match_subjects(
+        lambda fields: query_subjects(
+            project, username, password, "Lane Subset", lims_query, fields, use_cache=False
+        ),
+        udf_names, lane_subsets, searches
+    )
+    writes.add("Lane Subset", changed_subjects("Lane Subset", lane_subsets, existing))
+    return lane_subsets
+
+def update_pa(project, username, password, context, outputs, writes):
     pool_aliquots = []
     pool_aliquots.append({
         "UID": context["poolAliquotUID"],
@@ -257,50 +334,49 @@ def update_pa(project, username, password, context, outputs):
         "Picard MAX_MISMATCHES": outputs["maxMismatches"],
         "Picard MIN_MISMATCH_DELTA": outputs["minMismatchDelta"],
     })
-    return import_subjects(project, username, password, "Pool Aliquot", pool_aliquots)
+    writes.add("Pool Aliquot", pool_aliquots)
 
-def import_chipseq_import_outputs(project, username, password, outputs):
+def import_chipseq_import_outputs(project, username, password, outputs, journal=None):
     # TODO missing Project information
     print("Importing chip seq import workflow outputs")
     print(outputs)
     print("Parsing context")
     context = json.loads(outputs["context"])
     print(context)
-    print(update_pa(project, username, password, context, outputs))
-    print("Importing LIMS_Lanes")
-    lims_lanes = import_lanes(
-        project, username, password, context, outputs
-    )
-    
-    copseqreqs = import_copseqreqs(project, username, password, context, outputs)
-    print("Importing Lane Subsets")
-    return(import_lane_subsets(
-        project, username, password, context, outputs, lims_lanes, copseqreqs
-    ))
-
-
-def import_chipseq_export_outputs(project, username, password, outputs):
+    # Only the lane subsets depend on earlier stages
+    results = run_import(project, username, password, lambda writes: [
+        Stage("pool_aliquot", lambda deps: update_pa(
+            project, username, password, context, outputs, writes
+        ), []),
+        Stage("lanes", lambda deps: import_lanes(
+            project, username, password, context, outputs
+        ), []),
+        Stage("copseqreqs", lambda deps: import_copseqreqs(
+            project, username, password, context, outputs
+        ), []),
+        Stage("lane_subsets", lambda deps: import_lane_subsets(
+            project, username, password, context, outputs,
+            deps["lanes"], deps["copseqreqs"], writes
+        ), ["lanes", "copseqreqs"]),
+    ], journal)
+    return results["lane_subsets"]
+
+
+def import_chipseq_export_outputs(project, username, password, outputs, journal=None):
     # Do nothing
     pass
 
 
-def import_alignments(project, username, password, context, outputs):
+def import_alignments(project, username, password, context, outputs, writes):
     genome = outputs["genomeName"]
     ref_seq = f"{genome}_picard"
     alignments = outputs["alignments"]
     pipeline_version = context.get("pipelineVersion")
     projects = context.get("projects", {})
     
-    lims_query = " OR ".join(
-        f'"Lane Subset"->name = \'{alignment["laneSubsetName"]}\''
-        for alignment in alignments
-    )
     udf_names = ["Lane Subset", "Reference Sequence"]
-    query_response = query_subjects(project, username, password, "Alignment", lims_query)
-    print(query_response)
-    parsed_response = parse_query(query_response, udf_names)
-
     lims_alignments = []
+    searches = []
     for alignment in alignments:
         lims_alignments.append({
             "Pipeline": "cloud",
@@ -316,16 +392,25 @@ def import_alignments(project, username, password, context, outputs):
             "ESTIMATED_LIBRARY_SIZE Picard": alignment["estimatedLibrarySize"],
             "Projects": projects.get(alignment["laneSubsetName"], []),
         })
-        uid_dict = check_subjects(parsed_response, {
+        searches.append({
             "Lane Subset": alignment["laneSubsetName"],
             "Reference Sequence": ref_seq,
         })
-        lims_alignments[-1].update(uid_dict)
+    uid_names, existing = match_subjects(
+        lambda fields: query_subjects_in(
+            project, username, password, "Alignment", '"Lane Subset"->name',
+            [alignment["laneSubsetName"] for alignment in alignments], fields,
+            use_cache=False
+        ),
+        udf_names, lims_alignments, searches, ["BAM Filename URI"]
+    )
 
-    uid_names = {str(d['id']): d['name'] for d in query_response['Subjects']}
     search_uids = [a.get('UID', '{}') for a in lims_alignments]
     search_names = ','.join([uid_names.get(uid, '{}') for uid in search_uids])
-    import_response = import_subjects(project, username, password, "Alignment", lims_alignments)
+    import_response = import_subjects(
+        project, username, password, "Alignment",
+        changed_subjects("Alignment", lims_alignments, existing)
+    )
     print(import_response)
     imported_names = import_response['names'].split(',')
     alignment_names = search_names.format(*imported_names).split(',')
@@ -333,17 +418,20 @@ def import_alignments(project, username, password, context, outputs):
     lane_alns_bucket = f"{project}-lane-alns"
     uid_map = _collect_uids(lims_alignments, import_response, "Lane Subset")
     alignment_updates = []
+    copies = []
     for name, alignment in zip(alignment_names, alignments):
         uid = uid_map.get(alignment["laneSubsetName"])
         id = f"{int(name.split()[-1]):06d}"
-        bam_uri = _copy_gcs_file(alignment["bam"], lane_alns_bucket, f"lane_aln_{id}.bam")
-        _copy_gcs_file(alignment["bai"], lane_alns_bucket, f"lane_aln_{id}.bai")
+        bam_uri = _gcs_uri(lane_alns_bucket, f"lane_aln_{id}.bam")
+        copies.append((alignment["bam"], bam_uri))
+        copies.append((alignment["bai"], _gcs_uri(lane_alns_bucket, f"lane_aln_{id}.bai")))
         alignment_updates.append({"UID": uid, "BAM Filename URI": bam_uri})
+    _copy_gcs_files(copies)
 
-    print(import_subjects(project, username, password, "Alignment", alignment_updates))
+    writes.add("Alignment", changed_subjects("Alignment", alignment_updates, existing))
     return alignment_names
 
-def import_app(project, username, password, context, outputs, alignment_names):
+def import_app(project, username, password, context, outputs, alignment_names, writes):
     genome = outputs["genomeName"]
     ref_seq = f"{genome}_picard"
     app = outputs["alignmentPostProcessing"]
@@ -364,13 +452,10 @@ def import_app(project, username, password, context, outputs, alignment_names):
         aggregation_value = "NA"
     
     lims_query = " AND ".join(
-        f'"Input_Alignments_SL" = \'{alignment}\''
+        f'"Input_Alignments_SL" = {quote_value(alignment)}'
         for alignment in alignment_names
     )
     udf_names = ["Input Alignments"]
-    query_response = query_subjects(project, username, password, "Alignment Post Processing", lims_query)
-    print(query_response)
-    parsed_response = parse_query(query_response, udf_names)
 
     app_subject = {
         "Pipeline": "cloud",
@@ -404,13 +489,22 @@ def import_app(project, username, password, context, outputs, alignment_names):
         app_subject["RF Second predicted epitope"] = predicted_epitopes[1]["name"]
         app_subject["RF Second epitope prediction probability"] = predicted_epitopes[1]["probability"]
 
-    uid_dict = check_subjects(parsed_response, {"Input Alignments": input_alignments})
-    app_subject.update(uid_dict)
+    uid_names, existing = match_subjects(
+        lambda fields: query_subjects(
+            project, username, password, "Alignment Post Processing", lims_query, fields,
+            use_cache=False
+        ),
+        udf_names, [app_subject], [{"Input Alignments": input_alignments}],
+        ["BAM_Filename_URI", "Genotyping Fingerprint URI", "Genotyping Fingerprint Self LOD",
+         "InsertSizeMetrics", "Vplot"]
+    )
 
-    uid_names = {str(d['id']): d['name'] for d in query_response['Subjects']}
     search_uid = app_subject.get('UID', '{}')
     search_name = uid_names.get(search_uid, '{}')
-    import_response = import_subjects(project, username, password, "Alignment Post Processing", [app_subject])
+    import_response = import_subjects(
+        project, username, password, "Alignment Post Processing",
+        changed_subjects("Alignment Post Processing", [app_subject], existing)
+    )
     print(import_response)
     imported_names = import_response['names'].split(',')
     app_name = search_name.format(*imported_names) if '{}' in str(search_name) else search_name
@@ -423,39 +517,47 @@ def import_app(project, username, password, context, outputs, alignment_names):
     reports_bucket = f"{project}-reports"
 
     id = f"{int(app_name.split()[-1]):06d}"
-    bam_uri = _copy_gcs_file(app["bam"], agg_alns_bucket, f"aggregated_aln_{id}.bam")      
-    _copy_gcs_file(app["bai"], agg_alns_bucket, f"aggregated_aln_{id}.bai")
+    bam_uri = _gcs_uri(agg_alns_bucket, f"aggregated_aln_{id}.bam")
+    copies = [
+        (app["bam"], bam_uri),
+        (app["bai"], _gcs_uri(agg_alns_bucket, f"aggregated_aln_{id}.bai")),
+    ]
 
     app_update = {"UID": app_uid, "BAM_Filename_URI": bam_uri}
 
     if app.get("fingerprintFile"):
-        app_update["Genotyping Fingerprint URI"] = _copy_gcs_file(
-            app["fingerprintFile"], agg_alns_bucket, f"aggregated_aln_{id}.fingerprint.bam")
+        fingerprint_uri = _gcs_uri(agg_alns_bucket, f"aggregated_aln_{id}.fingerprint.bam")
+        copies.append((app["fingerprintFile"], fingerprint_uri))
+        app_update["Genotyping Fingerprint URI"] = fingerprint_uri
         app_update["Genotyping Fingerprint Self LOD"] = app.get("fingerprintSelfLOD")
 
     if app.get("insertSizeHistogram"):
-        app_update["InsertSizeMetrics"] = _copy_public_gcs_file(
-            app["insertSizeHistogram"], reports_bucket, f"aggregated_aln_{id}.histogram.pdf")
+        histogram_uri = _gcs_uri(reports_bucket, f"aggregated_aln_{id}.histogram.pdf")
+        copies.append((app["insertSizeHistogram"], histogram_uri))
+        app_update["InsertSizeMetrics"] = _public_url(histogram_uri)
 
     if app.get("vplot"):
-        app_update["Vplot"] = _copy_public_gcs_file(
-            app["vplot"], reports_bucket, f"aggregated_aln_{id}.vplot.png")
+        vplot_uri = _gcs_uri(reports_bucket, f"aggregated_aln_{id}.vplot.png")
+        copies.append((app["vplot"], vplot_uri))
+        app_update["Vplot"] = _public_url(vplot_uri)
 
-    print(import_subjects(project, username, password, "Alignment Post Processing", [app_update]))
+    _copy_gcs_files(copies)
+
+    writes.add(
+        "Alignment Post Processing",
+        changed_subjects("Alignment Post Processing", [app_update], existing)
+    )
     return app_name
 
-def import_segmentations(project, username, password, context, outputs, app_name):
+def import_segmentations(project, username, password, context, outputs, app_name, writes):
     segmentations = outputs["segmentations"]
     pipeline_version = context.get("pipelineVersion")
     projects_set = _get_projects_set(context.get("projects", {}))
 
-    lims_query = "\"Alignment Post Processing\"->name = '{}'".format(app_name)
+    lims_query = "\"Alignment Post Processing\"->name = {}".format(quote_value(app_name))
     udf_names = ["Alignment Post Processing", "Segmenter"]
-    query_response = query_subjects(project, username, password, "Segmentation", lims_query)
-    print(query_response)
-    parsed_response = parse_query(query_response, udf_names)
-
     lims_segs = []
+    searches = []
     for seg in segmentations:
         lims_segs.append({
             "Pipeline Version": pipeline_version,
@@ -466,16 +568,22 @@ def import_segmentations(project, username, password, context, outputs, app_name
             "SPOT": seg["spot"],
             "Projects": projects_set,
         })
-        uid_dict = check_subjects(parsed_response, {
+        searches.append({
             "Alignment Post Processing": app_name,
             "Segmenter": seg["peakStyle"],
         })
-        lims_segs[-1].update(uid_dict)
+    uid_names, existing = match_subjects(
+        lambda fields: query_subjects(
+            project, username, password, "Segmentation", lims_query, fields, use_cache=False
+        ),
+        udf_names, lims_segs, searches, ["BED Filename URI"]
+    )
 
-    uid_names = {str(d['id']): d['name'] for d in query_response['Subjects']}
     search_uids = [s.get('UID', '{}') for s in lims_segs]
     search_names = ','.join([uid_names.get(uid, '{}') for uid in search_uids])
-    import_response = import_subjects(project, username, password, "Segmentation", lims_segs)
+    import_response = import_subjects(
+        project, username, password, "Segmentation", changed_subjects("Segmentation", lims_segs, existing)
+    )
     print(import_response)
     imported_names = import_response['names'].split(',')
     seg_names = search_names.format(*imported_names).split(',')
@@ -483,26 +591,26 @@ def import_segmentations(project, username, password, context, outputs, app_name
     segs_bucket = f"{project}-segmentations"
     uid_map = _collect_uids(lims_segs, import_response, "Segmenter")
     seg_updates = []
+    copies = []
     for name, seg in zip(seg_names, segmentations):
         uid = uid_map.get(seg["peakStyle"])
         id = f"{int(name.split()[-1]):06d}"
-        bed_uri = _copy_gcs_file(seg["bed"], segs_bucket, f"segmentation_{id}.bed")
+        bed_uri = _gcs_uri(segs_bucket, f"segmentation_{id}.bed")
+        copies.append((seg["bed"], bed_uri))
         seg_updates.append({"UID": uid, "BED Filename URI": bed_uri})
+    _copy_gcs_files(copies)
 
-    print(import_subjects(project, username, password, "Segmentation", seg_updates))
+    writes.add("Segmentation", changed_subjects("Segmentation", seg_updates, existing))
 
-def import_track(project, username, password, context, outputs, app_name):
+def import_track(project, username, password, context, outputs, app_name, writes):
     track = outputs["track"]
     genome = outputs["genomeName"]
     pipeline_version = context.get("pipelineVersion")
     projects_set = _get_projects_set(context.get("projects", {}))
     agg = context.get("aggregation")
 
-    lims_query = "\"Alignment Post Processing\"->name = '{}'".format(app_name)
+    lims_query = "\"Alignment Post Processing\"->name = {}".format(quote_value(app_name))
     udf_names = ["Alignment Post Processing"]
-    query_response = query_subjects(project, username, password, "Track", lims_query)
-    print(query_response)
-    parsed_response = parse_query(query_response, udf_names)
 
     track_subject = {
         "Pipeline Version": pipeline_version,
@@ -512,13 +620,19 @@ def import_track(project, username, password, context, outputs, app_name):
         "Alignment Post Processing": app_name,
         "Projects": projects_set,
     }
-    uid_dict = check_subjects(parsed_response, {"Alignment Post Processing": app_name})
-    track_subject.update(uid_dict)
+    uid_names, existing = match_subjects(
+        lambda fields: query_subjects(
+            project, username, password, "Track", lims_query, fields, use_cache=False
+        ),
+        udf_names, [track_subject], [{"Alignment Post Processing": app_name}],
+        ["BigWig Filename URI", "TDF Filename URI"]
+    )
 
-    uid_names = {str(d['id']): d['name'] for d in query_response['Subjects']}
     search_uid = track_subject.get('UID', '{}')
     search_name = uid_names.get(search_uid, '{}')
-    import_response = import_subjects(project, username, password, "Track", [track_subject])
+    import_response = import_subjects(
+        project, username, password, "Track", changed_subjects("Track", [track_subject], existing)
+    )
     print(import_response)
     imported_names = import_response['names'].split(',')
     track_name = search_name.format(*imported_names) if '{}' in str(search_name) else search_name
@@ -529,33 +643,46 @@ def import_track(project, username, password, context, outputs, app_name):
 
     tracks_bucket = f"{project}-tracks"
     id = f"{int(track_name.split()[-1]):06d}"
-    bw_uri = _copy_gcs_file(track["bigWig"], tracks_bucket, f"track_{id}.bw")
-    tdf_uri = _copy_gcs_file(track["tdf"], tracks_bucket, f"track_{id}.tdf")
+    bw_uri, tdf_uri = _copy_gcs_files([
+        (track["bigWig"], _gcs_uri(tracks_bucket, f"track_{id}.bw")),
+        (track["tdf"], _gcs_uri(tracks_bucket, f"track_{id}.tdf")),
+    ])
 
-    print(import_subjects(project, username, password, "Track", [{
+    writes.add("Track", changed_subjects("Track", [{
         "UID": track_uid, 
         "BigWig Filename URI": bw_uri, 
         "TDF Filename URI": tdf_uri
-    }]))
+    }], existing))
 
     if genome in ["hg38", "mm10"] and agg:
-        print(import_subjects(project, username, password, agg["type"], [
+        writes.add(agg["type"], [
             {"UID": str(agg["uid"]), "Track": track_name}
-        ]))
+        ])
 
-def import_chipseq_outputs(project, username, password, outputs):
+def import_chipseq_outputs(project, username, password, outputs, journal=None):
     print("Importing chip-seq workflow outputs")
     print(outputs)
     print("Parsing context")
     context = json.loads(outputs["context"])
-    alignment_names = import_alignments(project, username, password, context, outputs)
-    app_name = import_app(project, username, password, context, outputs, alignment_names)
-    import_segmentations(project, username, password, context, outputs, app_name)
-    import_track(project, username, password, context, outputs, app_name)
+    # Segmentations and the track only need the APP name
+    run_import(project, username, password, lambda writes: [
+        Stage("alignments", lambda deps: import_alignments(
+            project, username, password, context, outputs, writes
+        ), []),
+        Stage("app", lambda deps: import_app(
+            project, username, password, context, outputs, deps["alignments"], writes
+        ), ["alignments"]),
+        Stage("segmentations", lambda deps: import_segmentations(
+            project, username, password, context, outputs, deps["app"], writes
+        ), ["app"]),
+        Stage("track", lambda deps: import_track(
+            project, username, password, context, outputs, deps["app"], writes
+        ), ["app"]),
+    ], journal)
     # TODO: auto-launch CNV workflow when app_info["epitopes"] == "WCE"
 
 
-def import_cnv_outputs(project, username, password, outputs):
+def import_cnv_outputs(project, username, password, outputs, journal=None):
     context = json.loads(outputs["context"])
     predicted_epitopes = outputs.get("predictedEpitopes")
     app_update = {
@@ -576,19 +703,16 @@ def import_cnv_outputs(project, username, password, outputs):
     print(import_subjects(project, username, password, "Alignment Post Processing", [app_update]))
 
 
-def import_ss_lane_subsets(project, username, password, context, outputs, lims_lanes):
+def import_ss_lane_subsets(project, username, password, context, outputs, lims_lanes, writes):
     # Query for existing lanes
     pa_uid = context["poolAliquotUID"]
     lims_query = "\"SS-CoPA\"->\"SS-PA\"->id = {}".format(pa_uid)
     udf_names = ["SS-CoPA", "LIMS_Lane"]
-    query_response = query_subjects(project, username, password, "SS-LS", lims_query)
-    print(query_response)
-    parsed_response = parse_query(query_response, udf_names)
+    lane_subsets = []
+    searches = []
     for lane_output, lims_lane in zip(outputs["laneOutputs"], lims_lanes):
-        lane_subsets = []
-        buffer = []
         for library_output in lane_output["libraryOutputs"]:
-            buffer.append({
+            lane_subsets.append({
                 "LIMS_Lane": lims_lane,
                 "Reads 1 Filename URI": library_output["read1"],
                 "Reads 2 Filename URI": library_output["read2"] or '',
@@ -599,22 +723,20 @@ def import_ss_lane_subsets(project, username, password, context, outputs, lims_l
                 "PF Fragments (BC)": library_output["pfFragments"],
                 "DEMUX Version": outputs["pipelineVersion"]
             })
-            search_udfs = {
+            searches.append({
                 "SS-CoPA": library_output["name"],
                 "LIMS_Lane": lims_lane
-            }
-            uid_dict = check_subjects(parsed_response, search_udfs)
-            buffer[-1].update(uid_dict)
-            if len(buffer) == 10:
-                lane_subsets.append(buffer)
-                buffer = []  # Start a new buffer array
-        if buffer:
-            lane_subsets.append(buffer)
-        for group in lane_subsets:
-            print(import_subjects(project, username, password, "SS-LS", group))
-    return lane_subsets#import_subjects(project, username, password, "SS-LS", lane_subsets)
-
-def update_ss_pa(project, username, password, context, outputs):
+            })
+    _, existing = match_subjects(
+        lambda fields: query_subjects(
+            project, username, password, "SS-LS", lims_query, fields, use_cache=False
+        ),
+        udf_names, lane_subsets, searches
+    )
+    writes.add("SS-LS", changed_subjects("SS-LS", lane_subsets, existing))
+    return lane_subsets
+
+def update_ss_pa(project, username, password, context, outputs, writes):
     # Update SS-PA with R1 and R2 lengths
     # TODO single end runs
     pool_aliquots = []
@@ -623,9 +745,9 @@ def update_ss_pa(project, username, password, context, outputs):
         "Read1_Length": outputs["r1Length"],
         "Read2_Length": outputs["r2Length"]
     })
-    return import_subjects(project, username, password, "SS-PA", pool_aliquots)
+    writes.add("SS-PA", pool_aliquots)
 
-def import_shareseq_import_outputs(project, username, password, outputs):
+def import_shareseq_import_outputs(project, username, password, outputs, journal=None):
     # TODO missing Project information
     print("Importing share seq import workflow outputs")
     print(outputs)
@@ -633,25 +755,25 @@ def import_shareseq_import_outputs(project, username, password, outputs):
     context = json.loads(outputs["context"])
     print(context)
 
-    print(update_ss_pa(project, username, password, context, outputs))
-
-    print("Importing LIMS_Lanes")
-    lims_lanes = import_lanes(
-        project, username, password, context, outputs
-    )
-
-    print("Importing SS-Lane Subsets")
-    import_ss_lane_subsets(
-        project, username, password, context, outputs, lims_lanes
-    )
+    run_import(project, username, password, lambda writes: [
+        Stage("pool_aliquot", lambda deps: update_ss_pa(
+            project, username, password, context, outputs, writes
+        ), []),
+        Stage("lanes", lambda deps: import_lanes(
+            project, username, password, context, outputs
+        ), []),
+        Stage("lane_subsets", lambda deps: import_ss_lane_subsets(
+            project, username, password, context, outputs, deps["lanes"], writes
+        ), ["lanes"]),
+    ], journal)
 
 
-def import_shareseq_proto_outputs(project, username, password, outputs):
+def import_shareseq_proto_outputs(project, username, password, outputs, journal=None):
     # Do nothing
     pass
 
 
-def update_10x_pa(project, username, password, context, outputs):
+def update_10x_pa(project, username, password, context, outputs, writes):
     # Update 10X-PA with R1, R2, I1, I2 lengths
     pool_aliquots = []
     pool_aliquots.append({
@@ -661,7 +783,7 @@ def update_10x_pa(project, username, password, context, outputs):
         "Index1_i7_Length": outputs["i1Length"],
         "Index2_i5_Length": outputs["i2Length"],
     })
-    return import_subjects(project, username, password, "10X-PA", pool_aliquots)
+    writes.add("10X-PA", pool_aliquots)
 
 def reshape_10x_fastqs(outputs):
     for lane in outputs.get("laneOutputs", []):
@@ -695,19 +817,16 @@ def reshape_10x_fastqs(outputs):
     
     return outputs
 
-def import_10x_lane_subsets(project, username, password, context, outputs, lims_lanes):
+def import_10x_lane_subsets(project, username, password, context, outputs, lims_lanes, writes):
     # Query for existing lanes
     pa_uid = context["poolAliquotUID"]
     lims_query = "\"10X-CoPA\"->\"10X-PA\"->id = {}".format(pa_uid)
     udf_names = ["10X-CoPA", "LIMS_Lane"]
-    query_response = query_subjects(project, username, password, "10X-LS", lims_query)
-    print(query_response)
-    parsed_response = parse_query(query_response, udf_names)
+    lane_subsets = []
+    searches = []
     for lane_output, lims_lane in zip(outputs["laneOutputs"], lims_lanes):
-        lane_subsets = []
-        buffer = []
         for library_output in lane_output["libraryOutputs"]:
-            buffer.append({
+            lane_subsets.append({
                 "LIMS_Lane": lims_lane,
                 "Reads 1 Filename URI": library_output["read1"],
                 "Reads 2 Filename URI": library_output.get("read2", ''),
@@ -720,37 +839,35 @@ def import_10x_lane_subsets(project, username, password, context, outputs, lims_
                 # "PF Fragments (BC)": library_output["pfFragments"],
                 "DEMUX Version": outputs["pipelineVersion"]
             })
-            search_udfs = {
+            searches.append({
                 "10X-CoPA": library_output["name"],
                 "LIMS_Lane": lims_lane
-            }
-            uid_dict = check_subjects(parsed_response, search_udfs)
-            buffer[-1].update(uid_dict)
-            if len(buffer) == 10:
-                lane_subsets.append(buffer)
-                buffer = []  # Start a new buffer array
-        if buffer:
-            lane_subsets.append(buffer)
-        for group in lane_subsets:
-            print(import_subjects(project, username, password, "10X-LS", group))
-    return lane_subsets#import_subjects(project, username, password, "SS-LS", lane_subsets)
-
-def import_10x_import_outputs(project, username, password, outputs):
+            })
+    _, existing = match_subjects(
+        lambda fields: query_subjects(
+            project, username, password, "10X-LS", lims_query, fields, use_cache=False
+        ),
+        udf_names, lane_subsets, searches
+    )
+    writes.add("10X-LS", changed_subjects("10X-LS", lane_subsets, existing))
+    return lane_subsets
+
+def import_10x_import_outputs(project, username, password, outputs, journal=None):
     print("Importing 10x import workflow outputs")
     print(outputs)
     print("Parsing context")
     context = json.loads(outputs["context"])
     print(context)
 
-    print(update_10x_pa(project, username, password, context, outputs))
-
-    print("Importing LIMS_Lanes")
     reshape_10x_fastqs(outputs)
-    lims_lanes = import_lanes(
-        project, username, password, context, outputs
-    )
-        
-    print("Importing 10X-Lane Subsets")
-    import_10x_lane_subsets(
-        project, username, password, context, outputs, lims_lanes
-    )
+    run_import(project, username, password, lambda writes: [
+        Stage("pool_aliquot", lambda deps: update_10x_pa(
+            project, username, password, context, outputs, writes
+        ), []),
+        Stage("lanes", lambda deps: import_lanes(
+            project, username, password, context, outputs
+        ), []),
+        Stage("lane_subsets", lambda deps: import_10x_lane_subsets(
+            project, username, password, context, outputs, deps["lanes"], writes
+        ), ["lanes"]),
+    ], journal)
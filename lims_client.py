@@ -0,0 +1,499 @@
+import gzip
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LIMS_URL = "https://lims.{0}epi.broadinstitute.org/api"
+
+# Connection pool and timeout defaults, overridable per deployment
+POOL_SIZE = int(os.environ.get("LIMS_POOL_SIZE", "10"))
+CONNECT_TIMEOUT = float(os.environ.get("LIMS_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.environ.get("LIMS_READ_TIMEOUT", "300"))
+
+# Imports are sent as POST bodies in batches sized by their URL-encoded
+# bytes, before any compression.
+# The batch size starts at LIMS_BATCH_BYTES and adapts to server latency:
+# it halves when a batch takes longer than LIMS_TARGET_LATENCY seconds and
+# grows when batches come back well under it.
+BATCH_BYTES = int(os.environ.get("LIMS_BATCH_BYTES", "32000"))
+MIN_BATCH_BYTES = int(os.environ.get("LIMS_MIN_BATCH_BYTES", "2000"))
+MAX_BATCH_BYTES = int(os.environ.get("LIMS_MAX_BATCH_BYTES", "512000"))
+TARGET_LATENCY = float(os.environ.get("LIMS_TARGET_LATENCY", "5"))
+
+# Number of subjects requested per page of a query. Pages after the first
+# rely on the API honouring offset, which is unconfirmed, so the default
+# matches the single 5000-subject request the importers always made.
+PAGE_SIZE = int(os.environ.get("LIMS_PAGE_SIZE", "5000"))
+
+# Upper bound on the URL-encoded size of one query filter
+MAX_QUERY_BYTES = int(os.environ.get("LIMS_MAX_QUERY_BYTES", "4000"))
+
+# Query results read with use_cache are cached for LIMS_QUERY_CACHE_TTL
+# seconds in a per-instance LRU of LIMS_QUERY_CACHE_SIZE entries. Any
+# import of a subject type drops the cached queries for that type.
+QUERY_CACHE_TTL = float(os.environ.get("LIMS_QUERY_CACHE_TTL", "60"))
+QUERY_CACHE_SIZE = int(os.environ.get("LIMS_QUERY_CACHE_SIZE", "256"))
+
+# Gzip import request bodies; requires server support for Content-Encoding
+GZIP_REQUESTS = os.environ.get("LIMS_GZIP_REQUESTS", "").lower() in ("1", "true", "yes")
+
+
+def encoded_size(batch):
+    # Size of a batch as the URL-encoded "json" field of an import body
+    return len(quote_plus(json.dumps(batch)))
+
+
+def batch_by_bytes(records, max_bytes):
+    """
+    Splits records into batches whose URL-encoded JSON stays under
+    max_bytes. A record larger than max_bytes gets a batch of its own.
+    """
+    # Brackets encode to 3 bytes each and the ", " between records to 4
+    batches = []
+    batch = []
+    size = len(quote_plus("[]"))
+    for record in records:
+        record_size = len(quote_plus(json.dumps(record) + ", "))
+        if batch and size + record_size > max_bytes:
+            batches.append(batch)
+            batch = []
+            size = len(quote_plus("[]"))
+        batch.append(record)
+        size += record_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# A queried subject reduced to its id, name and the requested UDF values
+SubjectRecord = namedtuple("SubjectRecord", ["id", "name", "udfs"])
+
+
+def udf_value(udf):
+    if "subject_count" in udf:
+        return udf["subject_count"]
+    elif isinstance(udf["value"], dict):
+        return udf["value"]["name"]
+    else:
+        return udf["value"]
+
+
+def quote_value(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def membership_queries(field, values, max_bytes=MAX_QUERY_BYTES):
+    """
+    Builds `field = ('a','b',...)` filters over the given values, split
+    so that each filter stays under max_bytes once URL-encoded. `field` is
+    used as is so it can be a path such as '"CoPA"->name'.
+    """
+    prefix = f"{field} = ("
+    overhead = len(quote_plus(prefix + ")"))
+    queries = []
+    quoted = []
+    size = overhead
+    for value in dict.fromkeys(values):
+        value = quote_value(value)
+        value_size = len(quote_plus(value + ","))
+        if quoted and size + value_size > max_bytes:
+            queries.append(prefix + ",".join(quoted) + ")")
+            quoted = []
+            size = overhead
+        quoted.append(value)
+        size += value_size
+    if quoted:
+        queries.append(prefix + ",".join(quoted) + ")")
+    return queries
+
+
+class QueryCache:
+    """
+    Read-through cache of query results keyed by (subject_type, query,
+    udf_names). Entries expire after ttl seconds and are dropped when the
+    subject type is written.
+    """
+
+    def __init__(self, ttl=QUERY_CACHE_TTL, max_entries=QUERY_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _record(self, hit, key):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            total = self.hits + self.misses
+            print(f"LIMS query cache {'hit' if hit else 'miss'} for {key[0]} "
+                  f"(hit rate {self.hits}/{total})")
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry:
+                self.entries.move_to_end(key)
+        self._record(entry is not None, key)
+        return entry[1] if entry else None
+
+    def put(self, key, records):
+        with self.lock:
+            self.entries[key] = (time.time(), records)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, subject_type):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == subject_type]:
+                del self.entries[key]
+
+
+def merge_import_responses(responses):
+    # Batched imports report their new subjects as comma-separated strings
+    merged = {}
+    for response in responses:
+        for key, value in response.items():
+            if key in ("names", "ids") and merged.get(key):
+                if value:
+                    merged[key] = f"{merged[key]},{value}"
+            else:
+                merged[key] = value
+    return merged
+
+
+class LimsClient:
+    """
+    Thin wrapper around the LIMS API that keeps a pooled, keep-alive
+    requests.Session so the TCP/TLS handshake is paid once per client
+    instead of once per call.
+    """
+
+    def __init__(self, project, username, password, pool_size=POOL_SIZE,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 batch_bytes=BATCH_BYTES, compress=GZIP_REQUESTS):
+        self.url = LIMS_URL.format("dev-" if "dev" in project else "")
+        self.username = username
+        self.password = password
+        self.timeout = (connect_timeout, read_timeout)
+        self.batch_bytes = batch_bytes
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.pool_size = pool_size
+        self.cache = QueryCache()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True
+        )
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+        })
+
+    def get(self, params):
+        params = {
+            **params,
+            "username": self.username,
+            "password": self.password,
+        }
+        response = self.session.get(self.url, params=params, timeout=self.timeout)
+        print(f"Response: {response}")
+        return response.json()
+
+    def post(self, params):
+        body = urlencode({
+            **params,
+            "username": self.username,
+            "password": self.password,
+        }).encode()
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if self.compress:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        response = self.session.post(
+            self.url, data=body, headers=headers, timeout=self.timeout
+        )
+        print(f"Response: {response} ({len(body)} bytes sent)")
+        return response
+
+    def adapt_batch_bytes(self, elapsed):
+        with self.lock:
+            if elapsed > TARGET_LATENCY:
+                self.batch_bytes = max(MIN_BATCH_BYTES, self.batch_bytes // 2)
+            elif elapsed < TARGET_LATENCY / 4:
+                self.batch_bytes = min(MAX_BATCH_BYTES, int(self.batch_bytes * 1.5))
+
+    def import_batch(self, subject_type, batch):
+        """
+        Sends one batch, splitting it in half and retrying when the server
+        rejects it as too large. Returns the response and the call count.
+        """
+        start = time.monotonic()
+        response = self.post({
+            "method": "import_subjects",
+            "subject_type": subject_type,
+            "json": json.dumps(batch),
+        })
+        if response.status_code in (413, 414) and len(batch) > 1:
+            # Capped in the units batch_by_bytes measures, whether or not
+            # the rejected body was compressed
+            with self.lock:
+                self.batch_bytes = max(
+                    MIN_BATCH_BYTES, min(self.batch_bytes, encoded_size(batch) // 2)
+                )
+            print(f"Batch of {len(batch)} rejected ({response.status_code}), splitting")
+            half = len(batch) // 2
+            first, first_calls = self.import_batch(subject_type, batch[:half])
+            second, second_calls = self.import_batch(subject_type, batch[half:])
+            return merge_import_responses([first, second]), 1 + first_calls + second_calls
+        response.raise_for_status()
+        self.adapt_batch_bytes(time.monotonic() - start)
+        return response.json(), 1
+
+    def import_batches(self, subject_type, data, failed=None):
+        """
+        Imports records in adaptively sized batches and merges the
+        responses. Returns the merged response and the number of calls.
+
+        With a failed list, a batch that cannot be sent does not stop the
+        others; it is appended to the list with its error instead.
+        """
+        responses = []
+        calls = 0
+        try:
+            for batch in batch_by_bytes(data, self.batch_bytes) or [data]:
+                try:
+                    response, batch_calls = self.import_batch(subject_type, batch)
+                except Exception as err:
+                    if failed is None:
+                        raise
+                    print(f"Error: {err}")
+                    failed.append((batch, err))
+                    calls += 1
+                    continue
+                responses.append(response)
+                calls += batch_calls
+        finally:
+            self.cache.invalidate(subject_type)
+        return merge_import_responses(responses), calls
+
+    def import_subjects(self, subject_type, data):
+        return self.import_batches(subject_type, data)[0]
+
+    def query_subjects(self, subject_type, query, udf_names, use_cache=True):
+        """
+        Yields the SubjectRecords matching the query, from the query cache
+        when a fresh entry exists and from the server otherwise. Callers
+        that diff against the results or are about to create missing
+        subjects pass use_cache=False, which neither reads nor fills the
+        cache.
+        """
+        if not use_cache:
+            yield from self.fetch_subjects(subject_type, query, udf_names)
+            return
+        key = (subject_type, query, tuple(sorted(set(udf_names))))
+        cached = self.cache.get(key)
+        if cached is not None:
+            yield from cached
+            return
+        records = []
+        for record in self.fetch_subjects(subject_type, query, udf_names):
+            records.append(record)
+            yield record
+        self.cache.put(key, records)
+
+    def fetch_subjects(self, subject_type, query, udf_names, page_size=PAGE_SIZE):
+        """
+        Yields a SubjectRecord for every subject matching the query, one
+        page at a time. Only the UDFs in udf_names are requested from the
+        server and kept, so memory is bounded by the page size rather than
+        the size of the result.
+
+        Each subject is yielded once even if pages overlap. A full page
+        with no new subjects means the server ignored the offset; that
+        raises rather than return a truncated result, which would make
+        existing subjects look missing and get them created again.
+        """
+        udf_names = set(udf_names)
+        seen = set()
+        offset = 0
+        while True:
+            response = self.get({
+                "method": "subjects",
+                "subject_type": subject_type,
+                "query": query,
+                "udf_names": json.dumps(sorted(udf_names)),
+                "limit": str(page_size),
+                "offset": str(offset),
+            })
+            subjects = response["Subjects"]
+            new = [subject for subject in subjects if str(subject["id"]) not in seen]
+            if len(subjects) >= page_size and not new:
+                raise RuntimeError(
+                    f"LIMS returned the same {subject_type} subjects at offset {offset}; "
+                    f"more than {len(seen)} match {query!r} and cannot be paged"
+                )
+            for subject in new:
+                seen.add(str(subject["id"]))
+                yield SubjectRecord(
+                    str(subject["id"]),
+                    subject["name"],
+                    {
+                        udf["name"]: udf_value(udf)
+                        for udf in subject["udfs"]
+                        if udf["name"] in udf_names
+                    },
+                )
+            if len(subjects) < page_size:
+                return
+            offset += page_size
+
+    def query_subjects_in(self, subject_type, field, values, udf_names, use_cache=True):
+        """
+        Queries subjects whose field is one of values. Large value lists
+        are split into URL-safe filters that run concurrently; records
+        from all chunks are yielded in chunk order.
+        """
+        queries = membership_queries(field, values)
+        if len(queries) <= 1:
+            for query in queries:
+                yield from self.query_subjects(subject_type, query, udf_names, use_cache)
+            return
+        print(f"Splitting {subject_type} query into {len(queries)} chunks")
+        workers = min(len(queries), self.pool_size)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = executor.map(
+                lambda query: list(
+                    self.query_subjects(subject_type, query, udf_names, use_cache)
+                ),
+                queries,
+            )
+            for records in chunks:
+                yield from records
+
+
+# Clients live at module level so a warm Cloud Function instance
+# reuses its open connections across invocations
+_clients = {}
+
+
+def get_client(project, username, password):
+    key = (project, username, password)
+    if key not in _clients:
+        _clients[key] = LimsClient(project, username, password)
+    return _clients[key]
+
+
+class LimsWriteBuffer:
+    """
+    Per-invocation write-behind buffer for LIMS imports whose responses
+    are not needed. Records are grouped by subject type, updates to the
+    same UID are merged, and everything is sent on flush() in the
+    client's adaptively sized batches.
+
+    With a stage journal, pending records are saved with every completed
+    stage and restored on a retry, so writes of stages that are not run
+    again are not lost.
+    """
+
+    def __init__(self, client, journal=None):
+        self.client = client
+        self.pending = {}
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.journal = journal
+        if journal is not None:
+            for subject_type, records in journal.state.get("writes", {}).items():
+                self.add(subject_type, records)
+            journal.checkpoint("writes", self.snapshot)
+
+    @staticmethod
+    def _key(record):
+        # Records without a UID create new subjects and only merge with an
+        # identical record, e.g. one re-added by a retry
+        return record.get("UID") or json.dumps(record, sort_keys=True)
+
+    def add(self, subject_type, records):
+        if not records:
+            return
+        with self.lock:
+            self.writes += 1
+            pending = self.pending.setdefault(subject_type, {})
+            for record in records:
+                key = self._key(record)
+                if key in pending:
+                    pending[key].update(record)
+                else:
+                    pending[key] = dict(record)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                subject_type: list(records.values())
+                for subject_type, records in self.pending.items()
+            }
+
+    def restore(self, failed):
+        # Puts unsent records back under any added since the flush began
+        with self.lock:
+            for subject_type, records in failed.items():
+                restored = {self._key(record): dict(record) for record in records}
+                for key, record in self.pending.get(subject_type, {}).items():
+                    if key in restored:
+                        restored[key].update(record)
+                    else:
+                        restored[key] = record
+                self.pending[subject_type] = restored
+
+    def flush(self):
+        """
+        Sends all pending records. Records that could not be sent stay
+        pending, and journaled, and an error naming them is raised once
+        every subject type has been tried.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            writes, self.writes = self.writes, 0
+        calls = 0
+        failed = {}
+        errors = []
+        for subject_type, records in pending.items():
+            unsent = []
+            try:
+                response, type_calls = self.client.import_batches(
+                    subject_type, list(records.values()), unsent
+                )
+                calls += type_calls
+                print(response)
+            except Exception as err:
+                print(f"Error: {err}")
+                unsent = [(list(records.values()), err)]
+            if unsent:
+                failed[subject_type] = [record for batch, _ in unsent for record in batch]
+                errors.append(f"{len(failed[subject_type])} {subject_type} ({unsent[-1][1]})")
+        if failed:
+            self.restore(failed)
+        print(f"LIMS write buffer: {writes} writes sent in {calls} calls, "
+              f"saved {writes - calls} round-trips")
+        if self.journal is not None:
+            self.journal.save()
+        if failed:
+            raise RuntimeError(f"Failed to write LIMS records: {', '.join(errors)}")
@@ -1,35 +1,67 @@
 import io
 import os
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
-import requests
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import functions_framework
-from google.cloud import kms
-from google.cloud import storage
-import google.auth.transport.requests
-from google.oauth2 import service_account
 # from format_shareseq_proto_inputs import format_shareseq_proto_inputs
-from format_helpers import create_barcode_files
-from format_helpers import create_terra_table
-from format_helpers import create_terra_table_chip
-import trackview
-import imports
+import firecloud
+
+# Google clients, the LIMS importers and the format and trackview helpers
+# are imported by the functions that use them, so each entry point only
+# pays for its own dependencies on a cold start
 
 # from transfer import submit_bcl_transfer
 
+# Number of jobs submitted to Terra concurrently per launch request
+SUBMIT_WORKERS = int(os.environ.get("SUBMIT_WORKERS", "8"))
+
+# Refresh cached access tokens once they are this close to expiring
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# How long a claimed workflow-done event is left to the invocation that
+# claimed it; matches the function timeout so an attempt killed by the
+# timeout is taken over by the platform's retry
+EVENT_LEASE = timedelta(seconds=float(os.environ.get("EVENT_LEASE_SECONDS", "540")))
+
+# Read buffer for streaming Cromwell outputs from GCS
+GCS_READ_CHUNK_BYTES = int(os.environ.get("GCS_READ_CHUNK_BYTES", str(1024 * 1024)))
+
+# Decrypted SA keys and their credentials, kept for the life of the instance
+sa_key_cache = {}
+credentials_cache = {}
+credentials_lock = threading.Lock()
+
 
 def dict_to_bytes_io(d):
     return io.BytesIO(json.dumps(d).encode())
 
 
-def download_gcs_file(bucket, name):
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket)
-    blob = bucket.blob(name)
-    blob = blob.download_as_string()
-    blob = blob.decode("utf-8")
-    return json.loads(blob)
+def download_gcs_file(bucket, name, workflow_types=None):
+    """
+    Parses a Cromwell outputs JSON object straight from the GCS read
+    stream, one top-level field at a time, so the raw bytes and decoded
+    text are never held alongside the parsed outputs.
+
+    When workflow_types is given, an outputs object of any other
+    workflowType is rejected as soon as that field is read.
+    """
+    import ijson
+    from storage_helpers import get_storage_client
+
+    storage_client = get_storage_client()
+    blob = storage_client.bucket(bucket).blob(name)
+    outputs = {}
+    with blob.open("rb", chunk_size=GCS_READ_CHUNK_BYTES) as f:
+        for key, value in ijson.kvitems(f, "", use_float=True):
+            if key == "workflowType" and workflow_types is not None \
+                    and value not in workflow_types:
+                raise ValueError(f"Unknown workflow type {value} in gs://{bucket}/{name}")
+            outputs[key] = value
+    return outputs
 
 
 def get_runtime_options(project, sa_key):
@@ -51,7 +83,53 @@ def get_runtime_options(project, sa_key):
         }
     )
 
+def get_sa_key(project, kms_location, kms_key, encrypted_key):
+    sa_key = sa_key_cache.get(encrypted_key)
+    if sa_key is not None:
+        print("Cromwell SA key cache hit")
+        return sa_key
+    print("Cromwell SA key cache miss, decrypting with KMS")
+    from google.cloud import kms
+
+    client = kms.KeyManagementServiceClient()
+    key_name = client.crypto_key_path(project, kms_location, kms_key, kms_key)
+    decrypt_response = client.decrypt(
+        request={"name": key_name, "ciphertext": encrypted_key}
+    )
+    sa_key = json.loads(decrypt_response.plaintext)
+    sa_key_cache[encrypted_key] = sa_key
+    return sa_key
+
+
+def get_credentials(sa_key):
+    import google.auth.transport.requests
+    from google.oauth2 import service_account
+
+    with credentials_lock:
+        credentials = credentials_cache.get(sa_key["private_key_id"])
+        if credentials is None:
+            print("Cromwell SA credentials cache miss")
+            credentials = service_account.Credentials.from_service_account_info(
+                sa_key, scopes=["email", "openid", "profile"]
+            )
+            credentials_cache[sa_key["private_key_id"]] = credentials
+        else:
+            print("Cromwell SA credentials cache hit")
+
+        # Only refresh the token when it is missing or close to expiring
+        if (
+            not credentials.valid
+            or credentials.expiry is None
+            or credentials.expiry - datetime.utcnow() < TOKEN_REFRESH_MARGIN
+        ):
+            print("Refreshing Cromwell SA access token")
+            credentials.refresh(google.auth.transport.requests.Request())
+        return credentials
+
+
 def create_ucsc_trackview(project, request, credentials):
+    import trackview
+
     config = trackview.get_config(request['tracks'], credentials)
     bucket_name = "{0}-trackview".format(project)
     file_name = "{0}.txt".format(trackview.get_hash(request))
@@ -118,6 +196,8 @@ def format_cnv_inputs(project, request, configuration):
 
 
 def format_shareseq_import_inputs(project, request, configuration):
+    from format_helpers import create_barcode_files
+
     # Create and upload barcode files
     r1 = create_barcode_files(request.get('pipelines')[0].get('round1Barcodes'), project)
     r2 = create_barcode_files(request.get('pipelines')[0].get('round2Barcodes'), project)
@@ -148,6 +228,8 @@ def format_shareseq_import_inputs(project, request, configuration):
 
 
 def format_shareseq_proto_inputs(project, request, configuration):
+    from format_helpers import create_terra_table
+
     tsv = create_terra_table(request, project)
 
     configuration["inputs"] = {
@@ -162,6 +244,8 @@ def format_shareseq_proto_inputs(project, request, configuration):
 
 
 def format_chipseq_export_inputs(project, request, configuration):
+    from format_helpers import create_terra_table_chip
+
     tsv = create_terra_table_chip(request, project)
 
     configuration["inputs"] = {
@@ -210,7 +294,9 @@ def format_10x_import_inputs(project, request, configuration):
     print(f"SampleSheet written to: {output_file}")
     
     # Upload the CSV file to Google Cloud Storage
-    storage_client = storage.Client()
+    from storage_helpers import get_storage_client
+
+    storage_client = get_storage_client()
     bucket_name = "{0}-cromwell".format(project)
     
     bucket = storage_client.bucket(bucket_name)
@@ -260,17 +346,117 @@ wdls = {
     "10x-import": "10X-import",
 }
 
+# Parsers by workflow type, as names of functions in the imports module
 workflow_parsers = {
-    "chip-seq-import": imports.import_chipseq_import_outputs,
-    "chip-seq": imports.import_chipseq_outputs,
-    "chip-seq-export": imports.import_chipseq_export_outputs,
-    "cnv": imports.import_cnv_outputs,
-    "share-seq-import": imports.import_shareseq_import_outputs,
-    "share-seq-proto": imports.import_shareseq_proto_outputs,
-    "10x-import": imports.import_10x_import_outputs,
+    "chip-seq-import": "import_chipseq_import_outputs",
+    "chip-seq": "import_chipseq_outputs",
+    "chip-seq-export": "import_chipseq_export_outputs",
+    "cnv": "import_cnv_outputs",
+    "share-seq-import": "import_shareseq_import_outputs",
+    "share-seq-proto": "import_shareseq_proto_outputs",
+    "10x-import": "import_10x_import_outputs",
 }
 
 
+def submit_error(response):
+    # Error bodies may be HTML pages rather than JSON
+    return f"Submission failed with status {response.status_code}: {response.text[:500]}"
+
+
+def submit_job(project, req, header, index):
+    method = wdls[req["workflow"]]
+    try:
+        # Each job gets its own copy of the method configuration, so jobs
+        # (and concurrent invocations) never see each other's inputs
+        configuration = firecloud.get_cached_method_config(method, header)
+        configuration["inputs"] = {}
+        configuration["outputs"] = {}
+
+        inputs = formatters[req["workflow"]](project, req, configuration)
+        print(f"Method configuration: {json.dumps(inputs, indent=2)}")
+
+        # Identical inputs that are already running or have succeeded
+        # return the existing submission instead of starting another run
+        if not req.get("force"):
+            duplicate = firecloud.find_duplicate_submission(
+                index, method, inputs["inputs"], header
+            )
+            if duplicate:
+                print(f"Duplicate of submission {duplicate['submissionId']} "
+                      f"({duplicate['status']}), not resubmitting")
+                return {
+                    "subj_name": req["subj_name"],
+                    "response": {
+                        "submissionId": duplicate["submissionId"],
+                        "status": duplicate["status"],
+                        "duplicate": True,
+                    },
+                }
+
+        config_name = firecloud.get_job_config(
+            method, configuration, inputs["inputs"], header
+        )
+
+        # Submit the workflow to cromwell
+        response = firecloud.submit(config_name, req.get("subj_name"), header)
+        print(f"Cromwell tatus Code: {response.status_code}")
+        if not response.ok:
+            print(f"Cromwell response Text: {response.text}")
+            return {"subj_name": req.get("subj_name"), "error": submit_error(response)}
+        submission = response.json()
+        print(f"Cromwell response Text: {json.dumps(submission, indent=2)}")
+    except Exception as err:
+        # Isolate failures so one bad job does not sink the whole batch
+        print(f"Failed to submit {req.get('subj_name')}: {err}")
+        return {"subj_name": req.get("subj_name"), "error": str(err)}
+
+    # The job is running either way; a missed index entry only means an
+    # identical relaunch is not recognized as a duplicate
+    try:
+        firecloud.record_submission(
+            index, method, inputs["inputs"],
+            submission.get("submissionId"), req.get("subj_name")
+        )
+    except Exception as err:
+        print(f"Failed to record submission of {req.get('subj_name')}: {err}")
+
+    # Start the bcl transfer for import workflows
+    # if req['workflow'] == 'import':
+    #     submit_bcl_transfer(
+    #         project, req['bcl'], response.json()['id'], key_json)
+    return {"subj_name": req["subj_name"], "response": submission}
+
+
+def submit_batch(project, workflow, reqs, header):
+    method = wdls[workflow]
+    subj_names = [req.get("subj_name") for req in reqs]
+    try:
+        # The configuration is revalidated once for the whole batch
+        template = firecloud.get_cached_method_config(method, header)
+        rows = []
+        for req in reqs:
+            configuration = {**template, "inputs": {}, "outputs": {}}
+            rows.append(formatters[workflow](project, req, configuration)["inputs"])
+        response, row_names = firecloud.submit_entity_set(
+            method, template, rows, subj_names, header
+        )
+        print(f"Cromwell tatus Code: {response.status_code}")
+        if not response.ok:
+            print(f"Cromwell response Text: {response.text}")
+            error = submit_error(response)
+            return [{"subj_name": name, "error": error} for name in subj_names]
+        submission = response.json()
+        print(f"Cromwell response Text: {json.dumps(submission, indent=2)}")
+    except Exception as err:
+        print(f"Failed to submit {workflow} batch: {err}")
+        return [{"subj_name": name, "error": str(err)} for name in subj_names]
+
+    return [
+        {"subj_name": name, "entityName": row_name, "response": submission}
+        for name, row_name in zip(subj_names, row_names)
+    ]
+
+
 @functions_framework.http
 def launch_cromwell(request):
     request_json = request.get_json(silent=True)
@@ -283,21 +469,10 @@ def launch_cromwell(request):
     kms_key = os.environ.get("KMS_KEY")
     kms_location = os.environ.get("KMS_LOCATION")
 
-    # Decrypt the Cromwell SA credentials
-    client = kms.KeyManagementServiceClient()
-    key_name = client.crypto_key_path(project, kms_location, kms_key, kms_key)
-    decrypt_response = client.decrypt(
-        request={"name": key_name, "ciphertext": encrypted_key}
-    )
-
-    sa_key = json.loads(decrypt_response.plaintext)
-
-    # Get authorization header for Cromwell SA
-    credentials = service_account.Credentials.from_service_account_info(
-        sa_key, scopes=["email", "openid", "profile"]
-    )
-    if not credentials.valid:
-        credentials.refresh(google.auth.transport.requests.Request())
+    # Decrypt the Cromwell SA credentials and get an authorization
+    # header for the Cromwell SA; both are cached on warm instances
+    sa_key = get_sa_key(project, kms_location, kms_key, encrypted_key)
+    credentials = get_credentials(sa_key)
     header = {}
     credentials.apply(header)
     
@@ -309,92 +484,146 @@ def launch_cromwell(request):
     # Get Cromwell runtime options
     options = get_runtime_options(project, sa_key)
 
-    # Submit jobs
-    responses = []
-    for req in request_json["jobs"]:
-        # Update method configuration
-        method = wdls[req["workflow"]]
-        method_endpoint = (
-            "https://api.firecloud.org/api/workspaces/"
-            "Shoresh_operations_workflows/lims_terra/"
-            f"method_configs/Shoresh_operations_workflows/{method}"
-        )
-        configuration = requests.get(method_endpoint, headers=header).json()
+    # Drop per-job method configurations left over from earlier launches
+    try:
+        firecloud.cleanup_job_configs(header)
+    except Exception as err:
+        print(f"Method configuration cleanup failed: {err}")
+
+    # Index of submitted inputs, used to avoid resubmitting identical jobs
+    from storage_helpers import get_state_store
+
+    index = get_state_store()
+
+    # Submit jobs concurrently; results are kept in the original job order
+    header["Content-Type"] = "application/json"
+    jobs = request_json["jobs"]
+    if request_json.get("batch"):
+        # One entity-set submission per workflow type
+        groups = {}
+        for i, req in enumerate(jobs):
+            groups.setdefault(req["workflow"], []).append(i)
+        workers = max(1, min(SUBMIT_WORKERS, len(groups)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                lambda workflow: submit_batch(
+                    project, workflow, [jobs[i] for i in groups[workflow]], header
+                ),
+                groups,
+            )
+            responses = [None] * len(jobs)
+            for workflow, group_responses in zip(groups, results):
+                for i, response in zip(groups[workflow], group_responses):
+                    responses[i] = response
+    else:
+        workers = max(1, min(SUBMIT_WORKERS, len(jobs)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            responses = list(
+                executor.map(lambda req: submit_job(project, req, header, index), jobs)
+            )
 
-        # Reset inputs and outputs
-        configuration["inputs"] = {}
-        configuration["outputs"] = {}
-        requests.post(method_endpoint, headers=header, json=configuration)
-
-        inputs = formatters[req["workflow"]](project, req, configuration)
-        header["Content-Type"] = "application/json"
-        print(f"Method configuration: {json.dumps(inputs, indent=2)}")
-
-        method_response = requests.post(
-            method_endpoint,
-            headers=header,
-            json=inputs
-        )
-        print(f"Status Code: {method_response.status_code}")
-        print(f"Response Text: {json.dumps(method_response.json(), indent=2)}")
-
-        comment = req.get("subj_name")
-
-        # Submit the workflow to cromwell
-        submission_manifest = {
-            "methodConfigurationNamespace": "Shoresh_operations_workflows",
-            "methodConfigurationName": method,
-            "userComment": comment[:1000] if len(comment) > 1000 else comment,
-            "entityType": None,
-            "entityName": None,
-            "expression": None,
-            "useCallCache": True,
-            "deleteIntermediateOutputFiles": False,
-            "useReferenceDisks": False,
-            "memoryRetryMultiplier": 1,
-            "workflowFailureMode": "NoNewCalls",
-            "ignoreEmptyOutputs": True
-        }
-
-        submission_endpoint = (
-            "https://api.firecloud.org/api/workspaces/"
-            "Shoresh_operations_workflows/lims_terra/submissions"
-        )
-
-        response = requests.post(
-            submission_endpoint, json=submission_manifest, headers=header
-        )
-
-        print(f"Cromwell tatus Code: {response.status_code}")
-        print(f"Cromwell response Text: {json.dumps(response.json(), indent=2)}")
+    return {"jobs": responses}
 
-        responses.append({"subj_name": req["subj_name"], "response": response.json()})
-        # Start the bcl transfer for import workflows
-        # if req['workflow'] == 'import':
-        #     submit_bcl_transfer(
-        #         project, req['bcl'], response.json()['id'], key_json)
 
-    return {"jobs": responses}
+class EventInProgress(Exception):
+    """
+    Raised for a delivery of an event that another invocation has claimed
+    and not finished. Failing the delivery, rather than acknowledging it,
+    makes the platform retry it, so the event is not lost if the claiming
+    attempt dies before it can release its claim.
+    """
+
+
+def claim_event(store, event_id, holder):
+    """
+    Claims a storage event for this invocation with a conditional create,
+    so that only one delivery of an at-least-once event does the work.
+
+    Returns False when the event is already done, and raises
+    EventInProgress while another invocation holds a live claim. Claims
+    older than EVENT_LEASE are taken over. The claim records its holder,
+    so a create that was retried after its response was lost recognizes
+    its own claim.
+    """
+    key = f"events/{event_id}"
+    now = datetime.utcnow()
+    claim = {"status": "running", "claimed": now.isoformat(), "holder": holder}
+    if store.create(key, claim):
+        return True
+    current = store.get(key)
+    if current is None:
+        if store.create(key, claim):
+            return True
+        raise EventInProgress(f"Event {event_id} was claimed by another invocation")
+    if current["status"] == "done":
+        print(f"Event {event_id} was already processed")
+        return False
+    if current.get("holder") == holder:
+        return True
+    if now - datetime.fromisoformat(current["claimed"]) < EVENT_LEASE:
+        raise EventInProgress(f"Event {event_id} is being processed by another invocation")
+    print(f"Taking over expired claim on event {event_id}")
+    if not store.replace(key, current, claim):
+        raise EventInProgress(f"Event {event_id} was claimed by another invocation")
+    return True
+
+
+def finish_event(store, event_id):
+    store.put(f"events/{event_id}", {
+        "status": "done", "finished": datetime.utcnow().isoformat()
+    })
+
+
+def release_event(store, event_id, holder):
+    # Lets the platform's retry of a failed attempt claim the event again,
+    # unless another invocation has taken the claim over meanwhile
+    key = f"events/{event_id}"
+    current = store.get(key)
+    if current is not None and current.get("holder") == holder:
+        store.delete(key, current)
 
 
 @functions_framework.cloud_event
 def on_workflow_done(cloud_event):
     print("on_workflow_done triggered")
+    from stages import StageJournal
+    from storage_helpers import get_state_store
+
+    # Storage events are delivered at least once; duplicates stop here
+    bucket = cloud_event.data["bucket"]
+    name = cloud_event.data["name"]
+    event_id = f"{bucket}/{name}/{cloud_event.data.get('generation')}"
+    state = get_state_store()
+    holder = uuid.uuid4().hex
+    if not claim_event(state, event_id, holder):
+        return
 
     # Grab lims user/password from secret
     username = os.environ.get("LIMS_USERNAME")
     password = os.environ.get("LIMS_PASSWORD")
     project = os.environ.get("PROJECT")
 
-    print("downloading file")
+    try:
+        print("downloading file")
+
+        # Download Cromwell job outputs from GCS
+        outputs = download_gcs_file(bucket, name, workflow_parsers)
+
+        # Completed import stages are journaled per outputs object so that a
+        # retry of this event resumes where the last attempt stopped
+        journal = StageJournal(state, event_id)
 
-    # Download Cromwell job outputs from GCS
-    outputs = download_gcs_file(cloud_event.data["bucket"], cloud_event.data["name"])
+        # Parse Cromwell job outputs and write to LIMS
+        workflow = outputs["workflowType"]
+        print(f"Workflow completion: {workflow}")
+        import imports
 
-    # Parse Cromwell job outputs and write to LIMS
-    workflow = outputs["workflowType"]
-    print(f"Workflow completion: {workflow}")
-    workflow_parsers[workflow](project, username, password, outputs)
+        parser = getattr(imports, workflow_parsers[workflow])
+        parser(project, username, password, outputs, journal)
+    except Exception:
+        release_event(state, event_id, holder)
+        raise
+    finish_event(state, event_id)
 
     # TODO launch any other jobs that need to run
     # subsequently
@@ -0,0 +1,83 @@
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# A unit of import work. `run` is called with a dict holding the results
+# of the stages named in `deps` once all of them have finished.
+Stage = namedtuple("Stage", ["name", "run", "deps"])
+
+
+class StageJournal:
+    """
+    The completed stages of one event and their results, kept in a state
+    store so that a retried invocation resumes at the first unfinished
+    stage. Stage results must be JSON serializable.
+
+    Other components can register a checkpoint, a callable whose value is
+    saved alongside every stage; the value loaded from an earlier attempt
+    is available in `state`.
+    """
+
+    def __init__(self, store, event_id):
+        self.store = store
+        self.key = f"journal/{event_id}"
+        entry = store.get(self.key) or {}
+        self.results = entry.get("stages", {})
+        self.state = entry.get("state", {})
+        self.checkpoints = {}
+        if self.results:
+            print(f"Resuming after completed stages: {sorted(self.results)}")
+
+    def checkpoint(self, name, snapshot):
+        self.checkpoints[name] = snapshot
+
+    def record(self, name, result):
+        self.results[name] = result
+        self.save()
+
+    def save(self):
+        for name, snapshot in self.checkpoints.items():
+            self.state[name] = snapshot()
+        self.store.put(self.key, {"stages": self.results, "state": self.state})
+
+
+def run_stages(stages, journal=None):
+    """
+    Runs a dependency graph of stages, starting each stage as soon as its
+    dependencies have finished so independent stages run concurrently.
+
+    Returns the result of every stage by name. The first stage to raise
+    stops any further stages from starting and its exception propagates.
+    With a journal, stages it already holds are not run again and every
+    stage is recorded in it as soon as it finishes.
+    """
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in names]
+        if missing:
+            raise ValueError(f"Stage {stage.name} depends on unknown stages: {missing}")
+
+    results = {}
+    if journal is not None:
+        results.update(
+            (stage.name, journal.results[stage.name])
+            for stage in stages if stage.name in journal.results
+        )
+    pending = {stage.name: stage for stage in stages if stage.name not in results}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(dep in results for dep in stage.deps):
+                    deps = {dep: results[dep] for dep in stage.deps}
+                    running[executor.submit(stage.run, deps)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Stage dependencies form a cycle: {sorted(pending)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                print(f"Finished stage {name}")
+                if journal is not None:
+                    journal.record(name, results[name])
+    return results
@@ -0,0 +1,339 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from google.api_core import exceptions as gcs_exceptions
+from google.cloud import storage
+from requests.adapters import HTTPAdapter
+
+# Upper bound on concurrent GCS copies per import
+COPY_WORKERS = int(os.environ.get("GCS_COPY_WORKERS", "8"))
+
+# Connections kept by the shared GCS client; at least as many as the
+# concurrent copies so that none of them waits for or discards a connection
+GCS_POOL_SIZE = int(os.environ.get("GCS_POOL_SIZE", str(max(COPY_WORKERS, 10))))
+
+# Where small pieces of state that must survive a function retry and be
+# shared between instances are kept. STATE_BUCKET selects GCS and is set
+# by deploy.sh; outside Cloud Functions a local directory stands in for it.
+STATE_BUCKET = os.environ.get("STATE_BUCKET")
+STATE_DIR = os.environ.get("STATE_DIR", "/tmp/lims-state")
+
+# Leases on shared keys expire after LEASE_SECONDS so a crashed holder
+# blocks others only briefly; live holders renew them every third of that.
+# Waiters give up after LEASE_WAIT_SECONDS.
+LEASE_SECONDS = float(os.environ.get("LEASE_SECONDS", "120"))
+LEASE_WAIT_SECONDS = float(os.environ.get("LEASE_WAIT_SECONDS", "300"))
+
+CopyResult = namedtuple("CopyResult", ["src", "dst", "error"])
+
+# The client lives at module level so a warm Cloud Function instance
+# reuses its credentials and open connections across invocations
+_storage_client = None
+_storage_client_lock = threading.Lock()
+
+
+def get_storage_client():
+    """
+    Returns the process-wide GCS client, creating it on first use with a
+    connection pool of GCS_POOL_SIZE.
+    """
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            client = storage.Client()
+            # The client's authorized requests session holds the pool
+            adapter = HTTPAdapter(pool_connections=GCS_POOL_SIZE, pool_maxsize=GCS_POOL_SIZE)
+            client._http.mount("https://", adapter)
+            _storage_client = client
+    return _storage_client
+
+
+def split_gs_uri(uri):
+    bucket_name, blob_name = uri[5:].split("/", 1)
+    return bucket_name, blob_name
+
+
+class LocalStateStore:
+    """JSON documents stored as files in a local directory."""
+
+    # Stands in for GCS generation preconditions within one process
+    lock = threading.Lock()
+
+    def __init__(self, root=STATE_DIR):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(value, f)
+
+    def create(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with open(path, "x") as f:
+                json.dump(value, f)
+        except FileExistsError:
+            return False
+        return True
+
+    def replace(self, key, expected, value):
+        with self.lock:
+            if self.get(key) != expected:
+                return False
+            self.put(key, value)
+            return True
+
+    def delete(self, key, expected=None):
+        with self.lock:
+            if expected is not None and self.get(key) != expected:
+                return False
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                return expected is None
+            return True
+
+
+class GcsStateStore:
+    """JSON documents stored as objects under a prefix in a GCS bucket."""
+
+    def __init__(self, bucket_name, prefix="state", client=None):
+        self.bucket = (client or get_storage_client()).bucket(bucket_name)
+        self.prefix = prefix
+
+    def _blob(self, key):
+        return self.bucket.blob(f"{self.prefix}/{key}.json")
+
+    def get(self, key):
+        try:
+            return json.loads(self._blob(key).download_as_bytes())
+        except gcs_exceptions.NotFound:
+            return None
+
+    def put(self, key, value):
+        self._blob(key).upload_from_string(
+            json.dumps(value), content_type="application/json"
+        )
+
+    def create(self, key, value):
+        """Writes value only if key does not exist yet; returns whether it did."""
+        try:
+            self._blob(key).upload_from_string(
+                json.dumps(value), content_type="application/json",
+                if_generation_match=0,
+            )
+        except gcs_exceptions.PreconditionFailed:
+            return False
+        return True
+
+    def _get_current(self, key):
+        # The object and its value, read at a single generation
+        blob = self.bucket.get_blob(self._blob(key).name)
+        if blob is None:
+            return None, None
+        return blob, json.loads(blob.download_as_bytes(if_generation_match=blob.generation))
+
+    def replace(self, key, expected, value):
+        """Writes value only if key still holds expected; returns whether it did."""
+        try:
+            blob, current = self._get_current(key)
+            if blob is None or current != expected:
+                return False
+            blob.upload_from_string(
+                json.dumps(value), content_type="application/json",
+                if_generation_match=blob.generation,
+            )
+        except (gcs_exceptions.PreconditionFailed, gcs_exceptions.NotFound):
+            return False
+        return True
+
+    def delete(self, key, expected=None):
+        """
+        Deletes key. With expected, only deletes it while it still holds
+        expected, and returns whether it did.
+        """
+        if expected is None:
+            try:
+                self._blob(key).delete()
+            except gcs_exceptions.NotFound:
+                pass
+            return True
+        try:
+            blob, current = self._get_current(key)
+            if blob is None or current != expected:
+                return False
+            blob.delete(if_generation_match=blob.generation)
+        except (gcs_exceptions.PreconditionFailed, gcs_exceptions.NotFound):
+            return False
+        return True
+
+
+def get_state_store():
+    if STATE_BUCKET:
+        return GcsStateStore(STATE_BUCKET)
+    # Each function instance has its own /tmp, so a local store would
+    # neither serialize leases nor share claims or journals between them
+    if os.environ.get("K_SERVICE"):
+        raise RuntimeError("STATE_BUCKET must be set for a deployed function")
+    return LocalStateStore()
+
+
+@contextmanager
+def lease(name, store=None, ttl=LEASE_SECONDS, wait=LEASE_WAIT_SECONDS):
+    """
+    Holds an exclusive lease on name, across invocations and instances,
+    for the duration of the block.
+
+    The lease is a state store entry created with a conditional create;
+    other holders poll with backoff until it is released or has expired,
+    and expired leases are taken over with a conditional replace. While
+    the block runs, the lease is renewed in the background so that slow
+    LIMS calls do not outlive it, and it is released with a conditional
+    delete so that a lease taken over by someone else is left alone.
+    """
+    store = store or get_state_store()
+    key = f"leases/{name}"
+    holder = uuid.uuid4().hex
+    deadline = time.time() + wait
+    delay = 0.1
+    while True:
+        now = time.time()
+        entry = {"holder": holder, "expires": now + ttl}
+        if store.create(key, entry):
+            break
+        current = store.get(key)
+        if current is None:
+            continue
+        if current["expires"] < now and store.replace(key, current, entry):
+            print(f"Took over expired lease {name}")
+            break
+        if now > deadline:
+            raise TimeoutError(f"Timed out waiting for lease {name}")
+        print(f"Waiting for lease {name}")
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+    held = [entry]
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(ttl / 3):
+            renewed = {"holder": holder, "expires": time.time() + ttl}
+            if not store.replace(key, held[0], renewed):
+                print(f"Lost lease {name}")
+                return
+            held[0] = renewed
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        renewer.join()
+        store.delete(key, held[0])
+
+
+def copy_gcs_file(client, src_uri, dst_uri, state):
+    """
+    Copies src_uri to dst_uri with a resumable rewrite loop.
+
+    Large objects that change location or storage class take several
+    rewrite calls; the rewrite token is persisted in the state store after
+    each step so a retried invocation continues where the last one stopped.
+    Copies whose destination already matches the source crc32c and size
+    are skipped.
+    """
+    src_bucket_name, src_blob_name = split_gs_uri(src_uri)
+    dst_bucket_name, dst_blob_name = split_gs_uri(dst_uri)
+    src_blob = client.bucket(src_bucket_name).get_blob(src_blob_name)
+    if src_blob is None:
+        raise FileNotFoundError(f"Source object not found: {src_uri}")
+
+    dst_bucket = client.bucket(dst_bucket_name)
+    dst_blob = dst_bucket.get_blob(dst_blob_name)
+    if (
+        dst_blob is not None
+        and dst_blob.crc32c == src_blob.crc32c
+        and dst_blob.size == src_blob.size
+    ):
+        print(f"{dst_uri} is already up to date, skipping copy")
+        return dst_uri
+    dst_blob = dst_bucket.blob(dst_blob_name)
+
+    token_key = f"rewrite/{dst_bucket_name}/{dst_blob_name}"
+    saved = state.get(token_key)
+    token = None
+    persisted = saved is not None
+    if saved and saved["src"] == src_uri and saved["crc32c"] == src_blob.crc32c:
+        print(f"Resuming copy of {src_uri} at {saved['bytes_rewritten']} bytes")
+        token = saved["token"]
+
+    while True:
+        try:
+            token, bytes_rewritten, total_bytes = dst_blob.rewrite(src_blob, token=token)
+        except gcs_exceptions.BadRequest:
+            # A stale or foreign token; start the rewrite over
+            if token is None:
+                raise
+            print(f"Discarding stale rewrite token for {dst_uri}")
+            token = None
+            continue
+        if token is None:
+            break
+        persisted = True
+        state.put(token_key, {
+            "src": src_uri,
+            "crc32c": src_blob.crc32c,
+            "token": token,
+            "bytes_rewritten": bytes_rewritten,
+        })
+        print(f"Copied {bytes_rewritten}/{total_bytes} bytes of {src_uri}")
+
+    if persisted:
+        state.delete(token_key)
+    return dst_uri
+
+
+def copy_gcs_files(copies, max_workers=COPY_WORKERS):
+    """
+    Copies a list of (src_uri, dst_uri) pairs on a bounded thread pool
+    that shares a single storage client.
+
+    Returns a CopyResult per pair, in input order. A failed copy does not
+    stop the others; its exception is stored in CopyResult.error.
+    """
+    if not copies:
+        return []
+    client = get_storage_client()
+    state = get_state_store()
+
+    def run(pair):
+        src_uri, dst_uri = pair
+        try:
+            copy_gcs_file(client, src_uri, dst_uri, state)
+        except Exception as err:
+            print(f"Failed to copy {src_uri} to {dst_uri}: {err}")
+            return CopyResult(src_uri, dst_uri, err)
+        return CopyResult(src_uri, dst_uri, None)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(copies))) as executor:
+        return list(executor.map(run, copies))
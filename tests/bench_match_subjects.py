@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of matching built records against existing LIMS subjects:
+a 1500-library flowcell looked up in a 5000-subject query response, with
+the search-UDF index of parse_query against a scan of every subject.
+
+    python tests/bench_match_subjects.py
+"""
+import time
+
+import conftest  # noqa: F401
+from imports import check_subjects, parse_query
+from lims_client import SubjectRecord
+
+SUBJECTS = 5000
+LIBRARIES = 1500
+UDF_NAMES = ["Component of Pooled SeqReq", "LIMS_Lane"]
+
+
+def make_records(n):
+    return [
+        SubjectRecord(str(i), f"LS {i}", {
+            "Component of Pooled SeqReq": f"CSR {i}",
+            "LIMS_Lane": f"Lane {i % 8}",
+            "Reads 1 Filename URI": f"gs://bucket/{i}_R1.fastq.gz",
+        })
+        for i in range(n)
+    ]
+
+
+def scan(records, udf_names, search_udfs):
+    # One pass over every subject per lookup, as before the index
+    matches = [
+        record.id for record in records
+        if {name: record.udfs.get(name) for name in udf_names} == search_udfs
+    ]
+    return {"UID": matches[0]} if matches else {}
+
+
+def main():
+    records = make_records(SUBJECTS)
+    # Every third library already exists; the rest would be created
+    searches = [
+        {"Component of Pooled SeqReq": f"CSR {i * 3}", "LIMS_Lane": f"Lane {(i * 3) % 8}"}
+        for i in range(LIBRARIES)
+    ]
+
+    start = time.perf_counter()
+    scanned = [scan(records, UDF_NAMES, search) for search in searches]
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index, _, _ = parse_query(records, UDF_NAMES)
+    indexed = [check_subjects(index, search) for search in searches]
+    index_time = time.perf_counter() - start
+
+    assert scanned == indexed
+    print(f"{LIBRARIES} lookups in {SUBJECTS} subjects: "
+          f"scan {scan_time:.3f}s, index {index_time:.4f}s "
+          f"({scan_time / index_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
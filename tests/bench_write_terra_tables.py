@@ -0,0 +1,66 @@
+"""
+Benchmark of write_terra_tables.build_tables on a synthetic SHARE-seq run
+of 10k libraries, spread over a few PKRs and over a single one (the worst
+case for merging), with and without --group.
+
+    python tests/bench_write_terra_tables.py [--libraries N]
+"""
+import argparse
+import contextlib
+import io
+import json
+import random
+import resource
+import time
+
+import conftest  # noqa: F401
+from write_terra_tables import build_tables
+
+TYPES = ['ATAC', 'RNA', 'RNA-no-align', 'ATAC', 'RNA', 'Other']
+
+
+def make_records(n_libs, n_pkrs, seed=7):
+    """Lane subset records as create_terra_table builds them."""
+    rnd = random.Random(seed)
+    records = []
+    for i in range(n_libs):
+        typ = rnd.choice(TYPES)
+        lib = f"LIB{rnd.randint(0, n_libs // 4)}x{typ[0]}"
+        subsets = [f"SUB{rnd.randint(0, 95)}" for _ in range(rnd.randint(1, 4))]
+        fq1 = [f"gs://lane-subsets/{lib}_S1_L00{rnd.randint(1, 2)}_BCL_{s}_R1_001.fastq.gz" for s in subsets]
+        records.append({
+            'Library': lib,
+            'PKR': f"PKR {rnd.randrange(n_pkrs)}",
+            'R1_subset': ','.join(subsets),
+            'Type': typ,
+            'Whitelist': ','.join(f"gs://lane-subsets/{s}_whitelist.txt" for s in subsets),
+            'Raw_FASTQ_R1': ','.join(fq1),
+            'Raw_FASTQ_R2': ','.join(x.replace('_R1_', '_R2_') for x in fq1),
+            'Genome': rnd.choice(['hg38', 'mm10']),
+            'Notes': '',
+            'Context': json.dumps({'name': f"SS-LS {i}", 'uid': str(1000 + i)}),
+        })
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Terra table building')
+    parser.add_argument('--libraries', type=int, default=10000)
+    args = parser.parse_args()
+
+    for n_pkrs in (5, 1):
+        records = make_records(args.libraries, n_pkrs)
+        for group in (False, True):
+            start = time.perf_counter()
+            # build_tables prints every run row key
+            with contextlib.redirect_stdout(io.StringIO()):
+                tables = build_tables(records, 'RUN', group)
+            elapsed = time.perf_counter() - start
+            size = sum(len(table) for table in tables.values()) // 1024
+            print(f"{args.libraries} libraries, {n_pkrs} PKR(s), group={group!s:5}: "
+                  f"{elapsed:.2f}s, {size} KB of tables")
+    print(f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB")
+
+
+if __name__ == '__main__':
+    main()
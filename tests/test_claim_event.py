@@ -0,0 +1,35 @@
+from datetime import datetime
+
+import pytest
+
+import main
+from storage_helpers import LocalStateStore
+
+
+def test_claim_event_claims_once(tmp_path):
+    store = LocalStateStore(str(tmp_path))
+    assert main.claim_event(store, "bucket/run.json/1", "a")
+    # A retried create that lost its response recognizes its own claim
+    assert main.claim_event(store, "bucket/run.json/1", "a")
+
+
+def test_live_claim_is_retried_not_acked(tmp_path):
+    store = LocalStateStore(str(tmp_path))
+    main.claim_event(store, "bucket/run.json/1", "a")
+    with pytest.raises(main.EventInProgress):
+        main.claim_event(store, "bucket/run.json/1", "b")
+
+
+def test_done_event_returns_early(tmp_path):
+    store = LocalStateStore(str(tmp_path))
+    main.claim_event(store, "bucket/run.json/1", "a")
+    main.finish_event(store, "bucket/run.json/1")
+    assert not main.claim_event(store, "bucket/run.json/1", "b")
+
+
+def test_expired_claim_is_taken_over(tmp_path):
+    store = LocalStateStore(str(tmp_path))
+    claimed = (datetime.utcnow() - main.EVENT_LEASE).isoformat()
+    store.create("events/bucket/run.json/1", {"status": "running", "claimed": claimed, "holder": "a"})
+    assert main.claim_event(store, "bucket/run.json/1", "b")
+    assert store.get("events/bucket/run.json/1")["holder"] == "b"
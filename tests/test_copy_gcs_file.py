@@ -0,0 +1,142 @@
+import pytest
+from google.api_core import exceptions as gcs_exceptions
+
+from storage_helpers import LocalStateStore, copy_gcs_file
+
+# Bytes moved per rewrite call by the stand-in, so larger objects take
+# several calls like a cross-location or cross-storage-class rewrite
+REWRITE_STEP = 10
+
+
+class FakeBlob:
+    def __init__(self, gcs, bucket_name, name):
+        self.gcs = gcs
+        self.key = (bucket_name, name)
+
+    @property
+    def crc32c(self):
+        return self.gcs.objects[self.key]["crc32c"]
+
+    @property
+    def size(self):
+        return self.gcs.objects[self.key]["size"]
+
+    def rewrite(self, source, token=None):
+        self.gcs.calls.append(token)
+        if self.gcs.fail_at == len(self.gcs.calls):
+            raise gcs_exceptions.ServiceUnavailable("rewrite interrupted")
+        if token is not None and token not in self.gcs.tokens:
+            raise gcs_exceptions.BadRequest("invalid rewrite token")
+        total = self.gcs.objects[source.key]["size"]
+        done = self.gcs.tokens.pop(token, 0) + REWRITE_STEP
+        if done < total:
+            token = f"token-{done}"
+            self.gcs.tokens[token] = done
+            return token, done, total
+        self.gcs.objects[self.key] = dict(self.gcs.objects[source.key])
+        return None, total, total
+
+
+class FakeBucket:
+    def __init__(self, gcs, name):
+        self.gcs = gcs
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self.gcs, self.name, name)
+
+    def get_blob(self, name):
+        if (self.name, name) not in self.gcs.objects:
+            return None
+        return FakeBlob(self.gcs, self.name, name)
+
+
+class FakeGcs:
+    """A local GCS stand-in with multi-step rewrites and rewrite tokens."""
+
+    def __init__(self):
+        self.objects = {}
+        self.tokens = {}
+        self.calls = []
+        self.fail_at = None
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+
+SRC = "gs://src-bucket/aln/sample.bam"
+DST = "gs://dst-bucket/aln/sample.bam"
+TOKEN_KEY = "rewrite/dst-bucket/aln/sample.bam"
+
+
+@pytest.fixture
+def gcs():
+    gcs = FakeGcs()
+    gcs.objects[("src-bucket", "aln/sample.bam")] = {"crc32c": "abc==", "size": 35}
+    return gcs
+
+
+@pytest.fixture
+def state(tmp_path):
+    return LocalStateStore(str(tmp_path))
+
+
+def test_multi_step_rewrite(gcs, state):
+    assert copy_gcs_file(gcs, SRC, DST, state) == DST
+    assert gcs.calls == [None, "token-10", "token-20", "token-30"]
+    assert gcs.objects[("dst-bucket", "aln/sample.bam")]["crc32c"] == "abc=="
+    # The saved token is dropped once the copy completes
+    assert state.get(TOKEN_KEY) is None
+
+
+def test_resume_from_saved_token(gcs, state):
+    gcs.fail_at = 3
+    with pytest.raises(gcs_exceptions.ServiceUnavailable):
+        copy_gcs_file(gcs, SRC, DST, state)
+    saved = state.get(TOKEN_KEY)
+    assert saved["token"] == "token-20"
+    assert saved["bytes_rewritten"] == 20
+
+    # A retried invocation continues from the saved token
+    gcs.fail_at = None
+    gcs.calls.clear()
+    copy_gcs_file(gcs, SRC, DST, state)
+    assert gcs.calls == ["token-20", "token-30"]
+    assert state.get(TOKEN_KEY) is None
+
+
+def test_stale_token_restarts(gcs, state):
+    state.put(TOKEN_KEY, {
+        "src": SRC, "crc32c": "abc==", "token": "expired", "bytes_rewritten": 20,
+    })
+    copy_gcs_file(gcs, SRC, DST, state)
+    assert gcs.calls[:2] == ["expired", None]
+    assert ("dst-bucket", "aln/sample.bam") in gcs.objects
+    assert state.get(TOKEN_KEY) is None
+
+
+def test_token_for_other_source_is_ignored(gcs, state):
+    state.put(TOKEN_KEY, {
+        "src": SRC, "crc32c": "old==", "token": "token-20", "bytes_rewritten": 20,
+    })
+    copy_gcs_file(gcs, SRC, DST, state)
+    assert gcs.calls[0] is None
+    assert state.get(TOKEN_KEY) is None
+
+
+def test_skip_when_destination_matches(gcs, state):
+    gcs.objects[("dst-bucket", "aln/sample.bam")] = {"crc32c": "abc==", "size": 35}
+    assert copy_gcs_file(gcs, SRC, DST, state) == DST
+    assert gcs.calls == []
+
+
+def test_copy_when_destination_differs(gcs, state):
+    gcs.objects[("dst-bucket", "aln/sample.bam")] = {"crc32c": "abc==", "size": 34}
+    copy_gcs_file(gcs, SRC, DST, state)
+    assert gcs.calls[0] is None
+    assert gcs.objects[("dst-bucket", "aln/sample.bam")]["size"] == 35
+
+
+def test_missing_source(gcs, state):
+    with pytest.raises(FileNotFoundError):
+        copy_gcs_file(gcs, "gs://src-bucket/missing.bam", DST, state)
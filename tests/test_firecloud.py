@@ -0,0 +1,56 @@
+import firecloud
+
+WORKSPACE_URL = "https://api.firecloud.org/api/workspaces/Shoresh_operations_workflows/lims_terra"
+
+TEMPLATE = {
+    "namespace": "Shoresh_operations_workflows",
+    "name": "CNV",
+    "rootEntityType": None,
+    "methodRepoMethod": {"methodUri": "dockstore://cnv/main", "methodVersion": "3"},
+    "methodConfigVersion": 2,
+    "inputs": {},
+    "outputs": {},
+}
+
+
+class FakeResponse:
+    status_code = 201
+
+    def raise_for_status(self):
+        pass
+
+
+def test_create_job_config_posts_to_workspace_methodconfigs(monkeypatch):
+    posts = []
+    monkeypatch.setattr(
+        firecloud.requests, "post",
+        lambda url, headers, json: posts.append((url, headers, json)) or FakeResponse(),
+    )
+    header = {"Authorization": "Bearer token"}
+    inputs = {"CNVAnalysis.bam": '"gs://bucket/a.bam"'}
+
+    name = firecloud.create_job_config("CNV", TEMPLATE, inputs, header)
+
+    [(url, sent_header, body)] = posts
+    assert url == f"{WORKSPACE_URL}/methodconfigs"
+    assert sent_header == header
+    assert name.startswith(f"CNV{firecloud.JOB_CONFIG_MARKER}")
+    assert body == {
+        **TEMPLATE,
+        "namespace": "Shoresh_operations_workflows",
+        "name": name,
+        "inputs": inputs,
+        "outputs": {},
+    }
+    # The shared template is left untouched
+    assert TEMPLATE["name"] == "CNV" and TEMPLATE["inputs"] == {}
+
+
+def test_create_job_config_sets_root_entity_type(monkeypatch):
+    posts = []
+    monkeypatch.setattr(
+        firecloud.requests, "post",
+        lambda url, headers, json: posts.append(json) or FakeResponse(),
+    )
+    firecloud.create_job_config("CNV", TEMPLATE, {}, {}, root_entity_type="lims_CNV")
+    assert posts[0]["rootEntityType"] == "lims_CNV"
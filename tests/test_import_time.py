@@ -0,0 +1,53 @@
+"""
+Cold-start import cost of the function entry points, measured with
+python -X importtime in fresh interpreters. IMPORT_BUDGET_MS bounds the
+cumulative import time of main (the best of IMPORT_RUNS runs).
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "400"))
+IMPORT_RUNS = int(os.environ.get("IMPORT_RUNS", "3"))
+
+# Loaded only by the entry points or workflow types that use them
+LAZY_MODULES = [
+    "google.cloud.kms",
+    "google.cloud.storage",
+    "ijson",
+    "format_helpers",
+    "imports",
+    "lims_client",
+    "stages",
+    "storage_helpers",
+    "trackview",
+    "write_terra_tables",
+]
+
+
+def import_times(module):
+    """Returns the cumulative import time in microseconds of every module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_main_does_not_load_lazy_modules():
+    loaded = import_times("main")
+    assert [module for module in LAZY_MODULES if module in loaded] == []
+
+
+def test_main_import_time_within_budget():
+    best = min(import_times("main")["main"] for _ in range(IMPORT_RUNS)) / 1000
+    print(f"import main: {best:.0f} ms (budget {IMPORT_BUDGET_MS:.0f} ms)")
+    assert best <= IMPORT_BUDGET_MS
@@ -0,0 +1,46 @@
+import pytest
+
+from lims_client import LimsClient
+
+SUBJECTS = [
+    {"id": i, "name": f"LS {i}", "udfs": [{"name": "LIMS_Lane", "value": {"name": f"Lane {i % 8}"}}]}
+    for i in range(2500)
+]
+
+
+def fake_server(honours_offset):
+    calls = []
+
+    def get(params):
+        calls.append(params)
+        limit = int(params["limit"])
+        offset = int(params["offset"]) if honours_offset else 0
+        return {"Subjects": SUBJECTS[offset:offset + limit]}
+
+    return get, calls
+
+
+@pytest.fixture
+def client():
+    return LimsClient("project", "user", "password")
+
+
+def test_pages_through_all_subjects(client):
+    client.get, calls = fake_server(honours_offset=True)
+    records = list(client.fetch_subjects("Lane Subset", "q", ["LIMS_Lane"], page_size=1000))
+    assert [r.id for r in records] == [str(s["id"]) for s in SUBJECTS]
+    assert records[0].udfs == {"LIMS_Lane": "Lane 0"}
+    assert [c["offset"] for c in calls] == ["0", "1000", "2000"]
+
+
+def test_ignored_offset_raises_instead_of_truncating(client):
+    client.get, _ = fake_server(honours_offset=False)
+    with pytest.raises(RuntimeError, match="cannot be paged"):
+        list(client.fetch_subjects("Lane Subset", "q", ["LIMS_Lane"], page_size=1000))
+
+
+def test_default_page_covers_old_single_request(client):
+    client.get, calls = fake_server(honours_offset=False)
+    records = list(client.fetch_subjects("Lane Subset", "q", ["LIMS_Lane"]))
+    assert len(records) == 2500
+    assert len(calls) == 1
@@ -0,0 +1,129 @@
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import format_helpers
+import main
+import storage_helpers
+import trackview
+
+
+class FakeBlob:
+    def __init__(self, objects, bucket_name, name):
+        self.objects = objects
+        self.key = (bucket_name, name)
+        self.crc32c = "abc=="
+        self.size = 3
+
+    def open(self, mode, chunk_size=None):
+        return io.BytesIO(self.objects[self.key])
+
+    def exists(self):
+        return self.key in self.objects
+
+    def upload_from_filename(self, filename):
+        with open(filename, "rb") as f:
+            self.objects[self.key] = f.read()
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self.objects[self.key] = data.encode() if isinstance(data, str) else data
+
+    def download_as_bytes(self):
+        return self.objects[self.key]
+
+    def generate_signed_url(self, **kwargs):
+        return f"https://signed/{self.key[0]}/{self.key[1]}"
+
+
+class FakeBucket:
+    def __init__(self, objects, name):
+        self.objects = objects
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self.objects, self.name, name)
+
+    def get_blob(self, name):
+        if (self.name, name) not in self.objects:
+            return None
+        return self.blob(name)
+
+
+class FakeHttp:
+    def mount(self, prefix, adapter):
+        self.adapter = adapter
+
+
+class CountingClient:
+    """Stands in for storage.Client and counts how often it is built."""
+
+    constructed = 0
+    objects = {}
+
+    def __init__(self):
+        type(self).constructed += 1
+        self._http = FakeHttp()
+
+    def bucket(self, name):
+        return FakeBucket(self.objects, name)
+
+
+@pytest.fixture
+def client_class(monkeypatch):
+    CountingClient.constructed = 0
+    CountingClient.objects = {
+        ("proj-workflow-outputs", "run.json"): json.dumps({"workflowType": "cnv"}).encode(),
+        ("proj-aggregated-alns", "a.bam"): b"bam",
+        ("proj-alns", "a.bam"): b"bam",
+    }
+    monkeypatch.setattr(storage_helpers.storage, "Client", CountingClient)
+    monkeypatch.setattr(storage_helpers, "_storage_client", None)
+    monkeypatch.setattr(storage_helpers, "STATE_BUCKET", "proj-lims-state")
+    return CountingClient
+
+
+def on_workflow_done_calls():
+    main.download_gcs_file("proj-workflow-outputs", "run.json", main.workflow_parsers)
+    state = storage_helpers.get_state_store()
+    state.put("journal/event", {"stages": {}})
+    results = storage_helpers.copy_gcs_files([
+        ("gs://proj-aggregated-alns/a.bam", "gs://proj-alns/a.bam"),
+    ])
+    assert results[0].error is None
+
+
+def launch_cromwell_calls():
+    format_helpers.create_barcode_files([[["R1-A", "ACGT"]], [["R1-B", "TTGA"]]], "proj")
+    format_helpers.create_terra_table_chip({
+        "table_name": "chip",
+        "pool_components": [{
+            "libraries": "L1", "epitopes": "H3K4me3", "celltypes": "K562",
+            "reads1": ["gs://r1"], "reads2": ["gs://r2"], "ctrl_r1": [], "ctrl_r2": [],
+        }],
+    }, "proj")
+    trackview.create_config_file("proj-trackview", "abc.txt", "track", None)
+    trackview.generate_signed_url("proj-trackview", "session.txt", None)
+
+
+def test_one_client_per_process(client_class):
+    on_workflow_done_calls()
+    assert client_class.constructed == 1
+    # Later invocations on a warm instance reuse it
+    launch_cromwell_calls()
+    on_workflow_done_calls()
+    assert client_class.constructed == 1
+
+
+def test_concurrent_first_use_builds_one_client(client_class):
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        clients = list(executor.map(lambda _: storage_helpers.get_storage_client(), range(64)))
+    assert client_class.constructed == 1
+    assert all(client is clients[0] for client in clients)
+
+
+def test_pool_sized_for_copy_workers(client_class):
+    adapter = storage_helpers.get_storage_client()._http.adapter
+    assert adapter._pool_maxsize == storage_helpers.GCS_POOL_SIZE
+    assert storage_helpers.GCS_POOL_SIZE >= storage_helpers.COPY_WORKERS
@@ -1,7 +1,7 @@
 import datetime
 import hashlib
 import json
-from google.cloud import storage
+from storage_helpers import get_storage_client
 from math import isnan
 from urllib.parse import quote
 
@@ -60,7 +60,7 @@ def generate_signed_url(bucket_name, blob_name, credentials):
         This method requires a service account key file. You cannot use this if you are using Application Default
         Credentials from Google Compute Engine or from the Google Cloud SDK.
     """
-    storage_client = storage.Client()
+    storage_client = get_storage_client()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_name)
     
@@ -147,7 +147,7 @@ def get_config(tracks, credentials):
 
 def create_config_file(bucket_name, file_name, content, credentials, content_type="text/plain"):
     # Set up credentials and client
-    client = storage.Client()
+    client = get_storage_client()
     bucket = client.bucket(bucket_name)
     blob_name = f'{CONFIG_PREFIX}/{file_name}'
     blob = bucket.blob(blob_name)
@@ -1,9 +1,42 @@
 import csv
+import io
 import json
 import argparse
-import os 
+import os
+
+SUB_TABLE_HEADER = ['BCL', 'PKR', 'Library', 'R1_Subset', 'Whitelist', 'Raw_FASTQ_R1', 'Raw_FASTQ_R2', 'Genome', 'Notes']
+
+# Sub tables by library type; only ATAC and RNA libraries make up runs
+SUB_TABLES = [('atac', 'ATAC', 'scATAC'), ('rna', 'RNA', 'scRNA'), ('rna_no', 'RNA-no-align', 'scRNA-no-align')]
+
+class Metadata:
+	"""
+	Library contexts merged into comma-separated values, e.g. {"uid": "1,2"}.
+	Values are lists of parts that are joined once on output. Rows share
+	and update these objects in place exactly as the tables always have,
+	so the contexts in the run table are unchanged.
+	"""
+	__slots__ = ('parts',)
+
+	def __init__(self, values):
+		self.parts = {key: [value] for key, value in values.items()}
+
+	def update(self, other):
+		for key, value in other.parts.items():
+			if key in self.parts:
+				if len(value) == 1:
+					self.parts[key].append(f",{value[0]}")
+				else:
+					self.parts[key] += [","] + value
+			else:
+				self.parts[key] = list(value)
+
+	def values(self):
+		return {key: value[0] if len(value) == 1 else ''.join(value) for key, value in self.parts.items()}
 
 class SubTableRow:
+	__slots__ = ('pkr', 'lib', 'r1', 'whitelist', 'fq1', 'fq2', 'genome', 'notes', 'metadata')
+
 	def __init__(self, pkr, lib, r1, whitelist, fq1, fq2, genome, notes, metadata):
 		self.pkr = pkr
 		self.lib = lib
@@ -14,49 +47,43 @@ class SubTableRow:
 		self.genome = genome
 		self.notes = notes
 		self.metadata = metadata
-	
-	def update_metadata(self, update_dict):
-		for key, value in update_dict.items():
-			if key in self.metadata:
-				self.metadata[key] += f",{value}"
-			else:
-				self.metadata[key] = value
+
+class Libraries:
+	"""The libraries, FASTQs and merged contexts of one type in a run row."""
+	__slots__ = ('lib', 'fq1', 'fq2', 'meta')
+
+	def __init__(self, lib = None, fq1 = None, fq2 = None, meta = None):
+		self.lib = lib if lib is not None else []
+		self.fq1 = fq1 if fq1 is not None else []
+		self.fq2 = fq2 if fq2 is not None else []
+		self.meta = meta if meta is not None else Metadata({})
+
+	def copy(self):
+		# New lists, but the same shared context object
+		return Libraries(list(self.lib), list(self.fq1), list(self.fq2), self.meta)
+
+	def add(self, other):
+		self.lib += other.lib
+		self.fq1 += other.fq1
+		self.fq2 += other.fq2
+		self.meta.update(other.meta)
 
 class MainTableRow:
-	def __init__(self, pkr, r1, whitelist, genome, rna_lib = None, rna_fq1 = None, rna_fq2 = None, rna_meta = None, atac_lib = None, atac_fq1 = None, atac_fq2 = None, atac_meta = None, notes = None):
+	__slots__ = ('pkr', 'r1', 'whitelist', 'genome', 'atac', 'rna')
+
+	def __init__(self, pkr, r1, whitelist, genome, atac = None, rna = None):
 		self.pkr = pkr
 		self.r1 = r1
 		self.whitelist = whitelist
 		self.genome = genome
-		self.rna_lib = rna_lib if rna_lib is not None else []
-		self.rna_fq1 = rna_fq1 if rna_fq1 is not None else []
-		self.rna_fq2 = rna_fq2 if rna_fq2 is not None else []
-		self.rna_meta = rna_meta if rna_meta is not None else {}
-		self.atac_lib = atac_lib if atac_lib is not None else []
-		self.atac_fq1 = atac_fq1 if atac_fq1 is not None else []
-		self.atac_fq2 = atac_fq2 if atac_fq2 is not None else []
-		self.atac_meta = atac_meta if atac_meta is not None else {}
-		self.notes = notes
-	
-	def update_rna_meta(self, update_dict):
-		for key, value in update_dict.items():
-			if key in self.rna_meta:
-				self.rna_meta[key] += f",{value}"
-			else:
-				self.rna_meta[key] = value
-	
-	def update_atac_meta(self, update_dict):
-		for key, value in update_dict.items():
-			if key in self.atac_meta:
-				self.atac_meta[key] += f",{value}"
-			else:
-				self.atac_meta[key] = value
+		self.atac = atac if atac is not None else Libraries()
+		self.rna = rna if rna is not None else Libraries()
 
 def make_sub_key(lib, r1, bcl):
 	return lib + "-" + r1 + "-" + bcl
 
 def make_main_key(pkr, r1, group):
-	key = pkr if group else pkr + "-" + r1 
+	key = pkr if group else pkr + "-" + r1
 	return key.replace(' ', '-')
 
 def get_subset_names(fqs):
@@ -64,190 +91,112 @@ def get_subset_names(fqs):
 	# Subset name is between Lane number and Read number
 	return [x.split('_L')[1].split('_R')[0].split('_')[2] for x in basenames]
 
-def update_sub_dict(key, pkr, lib, r1, whitelist, fq1, fq2, typ, genome, notes, metadata):
-	if typ == 'ATAC':
-		if key not in atac:
-			atac[key] = SubTableRow(pkr, lib, r1, whitelist, [fq1], [fq2], genome, notes, metadata)
-		else:
-			atac[key].fq1.append(fq1)
-			atac[key].fq2.append(fq2)
-			atac[key].update_metadata(metadata)
-	if typ == 'RNA':
-		if key not in rna:
-			rna[key] = SubTableRow(pkr, lib, r1, whitelist, [fq1], [fq2], genome, notes, metadata)
-		else:
-			rna[key].fq1.append(fq1)
-			rna[key].fq2.append(fq2)
-			rna[key].update_metadata(metadata)
-	if typ == 'RNA-no-align':
-		if key not in rna_no:
-			rna_no[key] = SubTableRow(pkr, lib, r1, whitelist, [fq1], [fq2], genome, notes, metadata)
-		else:
-			rna_no[key].fq1.append(fq1)
-			rna_no[key].fq2.append(fq2)
-			rna_no[key].update_metadata(metadata)
-
-def update_main_dict(key, pkr, r1, whitelist, genome, rna_lib = None, rna_fq1 = None, rna_fq2 = None, rna_meta = None, atac_lib = None, atac_fq1 = None, atac_fq2 = None, atac_meta = None):
-	if rna_lib is None:
-		if key not in main:
-			main[key] = MainTableRow(pkr, [r1], whitelist, genome, atac_lib = [atac_lib], atac_fq1 = atac_fq1, atac_fq2 = atac_fq2, atac_meta = atac_meta)
-		else:
-			main[key].r1.append(r1)
-			main[key].atac_lib.append(atac_lib)
-			main[key].atac_fq1 += atac_fq1
-			main[key].atac_fq2 += atac_fq2
-			main[key].update_atac_meta(atac_meta)
-	if atac_lib is None:
-		if key not in main:
-			main[key] = MainTableRow(pkr, [r1], whitelist, genome, rna_lib = [rna_lib], rna_fq1 = rna_fq1, rna_fq2 = rna_fq2, rna_meta = rna_meta)
-		else:
-			main[key].r1.append(r1)
-			main[key].rna_lib.append(rna_lib)
-			main[key].rna_fq1 += rna_fq1
-			main[key].rna_fq2 += rna_fq2
-			main[key].update_rna_meta(rna_meta)
-
-def update_main_subsets(key, pkr, r1, whitelist, rna_lib = None, rna_fq1 = None, rna_fq2 = None, rna_meta = None, atac_lib = None, atac_fq1 = None, atac_fq2 = None, atac_meta = None):
-	if len(rna_lib) == 0:
-		if key not in main:
-			main[key] = MainTableRow(pkr, r1, whitelist, genome, atac_lib = atac_lib, atac_fq1 = atac_fq1, atac_fq2 = atac_fq2, atac_meta = atac_meta)
-		else:
-			main[key].r1 += r1
-			main[key].atac_lib += atac_lib
-			main[key].atac_fq1 += atac_fq1
-			main[key].atac_fq2 += atac_fq2
-			main[key].update_atac_meta(atac_meta)
-	elif len(atac_lib) == 0:
-		if key not in main:
-			main[key] = MainTableRow(pkr, r1, whitelist, genome, rna_lib = rna_lib, rna_fq1 = rna_fq1, rna_fq2 = rna_fq2, rna_meta = rna_meta)
-		else:
-			main[key].r1 += r1
-			main[key].rna_lib += rna_lib
-			main[key].rna_fq1 += rna_fq1
-			main[key].rna_fq2 += rna_fq2
-			main[key].update_rna_meta(rna_meta)
+def fastq_list(fqs):
+	return '["' + '","'.join(fqs) + '"]'
+
+def new_table_writer():
+	out = io.StringIO()
+	return out, csv.writer(out, delimiter='\t', quotechar=None, quoting=csv.QUOTE_NONE)
+
+def add_main_row(main, key, pkr, r1, whitelist, genome, typ, libraries):
+	if key not in main:
+		main[key] = MainTableRow(pkr, r1, whitelist, genome, **{typ: libraries})
 	else:
-		if key not in main:
-			main[key] = MainTableRow(pkr, r1, whitelist, genome, rna_lib = rna_lib, rna_fq1 = rna_fq1, rna_fq2 = rna_fq2, rna_meta = rna_meta, atac_lib = atac_lib, atac_fq1 = atac_fq1, atac_fq2 = atac_fq2, atac_meta = atac_meta)
+		main[key].r1 += r1
+		getattr(main[key], typ).add(libraries)
+
+def build_tables(records, name, group=False):
+	"""
+	Builds the Terra tables for one run from lane subset records, dicts
+	keyed by the columns of the input TSV, in a single pass over them.
+	Returns the atac, rna, rna_no and run tables as TSV text, keyed by
+	table name.
+	"""
+	sub_tables = {typ: dict() for _, typ, _ in SUB_TABLES}
+	main = dict()
+
+	genome = None
+	for record in records:
+		table = sub_tables.get(record['Type'])
+		pkr = record['PKR']
+		lib = record['Library']
+		fq1 = sorted(record['Raw_FASTQ_R1'].split(','))
+		fq2 = sorted(record['Raw_FASTQ_R2'].split(','))
+		r1 = get_subset_names(fq1)
+		whitelist = sorted(record['Whitelist'].split(','))
+		genome = record['Genome']
+		# All subsets of a record share one context object
+		metadata = Metadata(json.loads(record['Context'].replace('\\"','"')))
+		if table is None:
+			continue
+		for i in range(len(r1)):
+			key = make_sub_key(lib, r1[i], name)
+			row = table.get(key)
+			if row is None:
+				table[key] = SubTableRow(pkr, lib, r1[i], whitelist[i], [fq1[i]], [fq2[i]], genome, record['Notes'], metadata)
+			else:
+				row.fq1.append(fq1[i])
+				row.fq2.append(fq2[i])
+				row.metadata.update(metadata)
+
+	tables = {}
+	for table_name, typ, entity in SUB_TABLES:
+		out, tsv_writer = new_table_writer()
+		tsv_writer.writerow(['entity:{}_libraries_id'.format(entity)] + SUB_TABLE_HEADER)
+		for key, row in sub_tables[typ].items():
+			tsv_writer.writerow([key, name, row.pkr, row.lib, row.r1, row.whitelist, fastq_list(row.fq1), fastq_list(row.fq2), row.genome, row.notes])
+			# Merged run rows take the genome of the last library written
+			genome = row.genome
+			if typ != 'RNA-no-align':
+				libraries = Libraries([row.lib], list(row.fq1), list(row.fq2), row.metadata)
+				add_main_row(main, make_main_key(row.pkr, row.r1, group), row.pkr, [row.r1], row.whitelist, row.genome, table_name, libraries)
+		tables[table_name] = out.getvalue()
+
+	# Merge all subsets together
+	for key in list(main.keys()):
+		row = main[key]
+		r1 = list(set(row.r1))
+		if len(r1) == 1:
+			continue
+		atac = row.atac.copy()
+		rna = row.rna.copy()
+		merged_key = row.pkr.replace(' ', '_')
+		if len(rna.lib) == 0:
+			add_main_row(main, merged_key, row.pkr, r1, row.whitelist, genome, 'atac', atac)
+		elif len(atac.lib) == 0:
+			add_main_row(main, merged_key, row.pkr, r1, row.whitelist, genome, 'rna', rna)
+		elif merged_key not in main:
+			main[merged_key] = MainTableRow(row.pkr, r1, row.whitelist, genome, atac = atac, rna = rna)
 		else:
-			main[key].r1 += r1
-			main[key].atac_lib += atac_lib
-			main[key].atac_fq1 += atac_fq1
-			main[key].atac_fq2 += atac_fq2
-			main[key].update_atac_meta(atac_meta)
-			main[key].rna_lib += rna_lib
-			main[key].rna_fq1 += rna_fq1
-			main[key].rna_fq2 += rna_fq2
-			main[key].update_rna_meta(rna_meta)
-
-parser = argparse.ArgumentParser( description='Generate tables for Terra')
-parser.add_argument('-i', '--input', type=str, required=True)
-parser.add_argument('-n', '--name', type=str, required=True)
-parser.add_argument('-m', '--meta', type=str, required=False)
-parser.add_argument('-d', '--dir', type=str, default='.')
-parser.add_argument('--group', action='store_true')
-args = parser.parse_args()
-
-atac = dict()
-rna = dict()
-rna_no = dict()
-main = dict()
-
-in_fh = open(args.input)#args.input)
-csv_reader = csv.DictReader(in_fh, delimiter='\t')
-
-for record in csv_reader:
-	pkr = record['PKR']
-	lib = record['Library']
-	fq1 = sorted(record['Raw_FASTQ_R1'].split(','))
-	fq2 = sorted(record['Raw_FASTQ_R2'].split(','))
-	r1 = get_subset_names(fq1)
-	whitelist = sorted(record['Whitelist'].split(','))
-	typ = record['Type']
-	genome = record['Genome']
-	notes = record['Notes']
-	metadata = json.loads(record['Context'].replace('\\"','"'))
-	for i in range(len(r1)):
-		key = make_sub_key(lib, r1[i], args.name)
-		update_sub_dict(key, pkr, lib, r1[i], whitelist[i], fq1[i], fq2[i], typ, genome, notes, metadata)
-
-with open('{}/atac.tsv'.format(args.dir), 'wt') as outfile:
-	tsv_writer = csv.writer(outfile, delimiter='\t', quotechar='', quoting=csv.QUOTE_NONE)
-	tsv_writer.writerow(['entity:scATAC_libraries_id', 'BCL', 'PKR', 'Library', 'R1_Subset', 'Whitelist', 'Raw_FASTQ_R1', 'Raw_FASTQ_R2', 'Genome', 'Notes'])
-	for key in atac.keys():
-		pkr = atac[key].pkr
-		lib = atac[key].lib
-		r1 = atac[key].r1
-		whitelist = atac[key].whitelist
-		fq1 = list(atac[key].fq1)
-		fq2 = list(atac[key].fq2)
-		genome = atac[key].genome
-		metadata = atac[key].metadata
-		tsv_writer.writerow([key, args.name, pkr, lib, r1, whitelist, '["' + '","'.join(fq1) + '"]', '["' + '","'.join(fq2) + '"]', genome, atac[key].notes])
-		main_key = make_main_key(pkr, r1, args.group)
-		update_main_dict(main_key, pkr, r1, whitelist, genome, atac_lib=lib, atac_fq1=fq1, atac_fq2=fq2, atac_meta = metadata)
-
-with open('{}/rna.tsv'.format(args.dir), 'wt') as outfile:
-	tsv_writer = csv.writer(outfile, delimiter='\t', quotechar='', quoting=csv.QUOTE_NONE)
-	tsv_writer.writerow(['entity:scRNA_libraries_id', 'BCL', 'PKR', 'Library', 'R1_Subset', 'Whitelist', 'Raw_FASTQ_R1', 'Raw_FASTQ_R2', 'Genome', 'Notes'])
-	for key in rna.keys():
-		pkr = rna[key].pkr
-		lib = rna[key].lib
-		r1 = rna[key].r1
-		whitelist = rna[key].whitelist
-		fq1 = list(rna[key].fq1)
-		fq2 = list(rna[key].fq2)
-		genome = rna[key].genome
-		metadata = rna[key].metadata
-		tsv_writer.writerow([key, args.name, pkr, lib, r1, whitelist, '["' + '","'.join(fq1) + '"]', '["' + '","'.join(fq2) + '"]', genome, rna[key].notes])
-		main_key = make_main_key(pkr, r1, args.group)
-		update_main_dict(main_key, pkr, r1, whitelist, genome, rna_lib=lib, rna_fq1=fq1, rna_fq2=fq2, rna_meta = metadata)
-
-with open('{}/rna_no.tsv'.format(args.dir), 'wt') as outfile:
-	tsv_writer = csv.writer(outfile, delimiter='\t', quotechar='', quoting=csv.QUOTE_NONE)
-	tsv_writer.writerow(['entity:scRNA-no-align_libraries_id', 'BCL', 'PKR', 'Library', 'R1_Subset', 'Whitelist', 'Raw_FASTQ_R1', 'Raw_FASTQ_R2', 'Genome', 'Notes'])
-	for key in rna_no.keys():
-		pkr = rna_no[key].pkr
-		lib = rna_no[key].lib
-		r1 = rna_no[key].r1
-		whitelist = rna_no[key].whitelist
-		fq1 = list(rna_no[key].fq1)
-		fq2 = list(rna_no[key].fq2)
-		genome = rna_no[key].genome
-		tsv_writer.writerow([key, args.name, pkr, lib, r1, whitelist, '["' + '","'.join(fq1) + '"]', '["' + '","'.join(fq2) + '"]', genome, rna_no[key].notes])
-
-# Merge all subsets together
-for key in list(main.keys()):
-	pkr = main[key].pkr
-	whitelist = main[key].whitelist
-	r1 = list(set(main[key].r1))
-	if len(r1) == 1:
-		continue
-	rna_lib = list(main[key].rna_lib)
-	rna_fq1 = list(main[key].rna_fq1)
-	rna_fq2 = list(main[key].rna_fq2)
-	rna_meta = main[key].rna_meta
-	atac_lib = list(main[key].atac_lib)
-	atac_fq1 = list(main[key].atac_fq1)
-	atac_fq2 = list(main[key].atac_fq2)
-	atac_meta = main[key].atac_meta
-	update_main_subsets(pkr.replace(' ', '_'), pkr, r1, whitelist, rna_lib=rna_lib, rna_fq1=rna_fq1, rna_fq2=rna_fq2, rna_meta = rna_meta, atac_lib=atac_lib, atac_fq1=atac_fq1, atac_fq2=atac_fq2, atac_meta = atac_meta)
-
-with open('{}/run.tsv'.format(args.dir), 'wt') as outfile:
-	tsv_writer = csv.writer(outfile, delimiter='\t', quotechar='', quoting=csv.QUOTE_NONE)
-	tsv_writer.writerow(['entity:' + args.name + '_id', 'PKR', 'Genome', 'R1_Subset', 'whitelist', 'ATAC_Lib', 'ATAC_raw_fastq_R1', 'ATAC_raw_fastq_R2', 'ATAC_context', 'RNA_Lib', 'RNA_raw_fastq_R1', 'RNA_raw_fastq_R2', 'RNA_context'])
+			main[merged_key].r1 += r1
+			main[merged_key].atac.add(atac)
+			main[merged_key].rna.add(rna)
+
+	out, tsv_writer = new_table_writer()
+	tsv_writer.writerow(['entity:' + name + '_id', 'PKR', 'Genome', 'R1_Subset', 'whitelist', 'ATAC_Lib', 'ATAC_raw_fastq_R1', 'ATAC_raw_fastq_R2', 'ATAC_context', 'RNA_Lib', 'RNA_raw_fastq_R1', 'RNA_raw_fastq_R2', 'RNA_context'])
 	for key in sorted(main.keys()):
 		print(key)
-		pkr = main[key].pkr
-		genome = main[key].genome
-		r1 = '["' + '","'.join(set(main[key].r1)) + '"]'
-		whitelist = main[key].whitelist
-		atac_lib = '["' + '","'.join(set(main[key].atac_lib)) + '"]'
-		atac_fq1 = '["' + '","'.join(main[key].atac_fq1) + '"]'
-		atac_fq2 = '["' + '","'.join(main[key].atac_fq2) + '"]'
-		atac_meta = json.dumps(main[key].atac_meta)
-		rna_lib = '["' + '","'.join(set(main[key].rna_lib)) + '"]'
-		rna_fq1 = '["' + '","'.join(main[key].rna_fq1) + '"]'
-		rna_fq2 = '["' + '","'.join(main[key].rna_fq2) + '"]'
-		rna_meta = json.dumps(main[key].rna_meta)
-		tsv_writer.writerow([key.replace(" ", "_"), pkr, genome, r1, whitelist, atac_lib, atac_fq1, atac_fq2, atac_meta, rna_lib, rna_fq1, rna_fq2, rna_meta]) 
\ No newline at end of file
+		row = main[key]
+		tsv_writer.writerow([
+			key.replace(" ", "_"), row.pkr, row.genome, fastq_list(set(row.r1)), row.whitelist,
+			fastq_list(set(row.atac.lib)), fastq_list(row.atac.fq1), fastq_list(row.atac.fq2), json.dumps(row.atac.meta.values()),
+			fastq_list(set(row.rna.lib)), fastq_list(row.rna.fq1), fastq_list(row.rna.fq2), json.dumps(row.rna.meta.values()),
+		])
+	tables['run'] = out.getvalue()
+	return tables
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser( description='Generate tables for Terra')
+	parser.add_argument('-i', '--input', type=str, required=True)
+	parser.add_argument('-n', '--name', type=str, required=True)
+	parser.add_argument('-m', '--meta', type=str, required=False)
+	parser.add_argument('-d', '--dir', type=str, default='.')
+	parser.add_argument('--group', action='store_true')
+	args = parser.parse_args()
+
+	with open(args.input) as in_fh:
+		tables = build_tables(csv.DictReader(in_fh, delimiter='\t'), args.name, args.group)
+
+	for table_name, content in tables.items():
+		with open('{}/{}.tsv'.format(args.dir, table_name), 'wt') as outfile:
+			outfile.write(content)